@@ -4,36 +4,270 @@ This lambda proxies requests to the necessary DSS endpoints and converts them
 to DOS messages.
 
 """
+import base64
+import collections
+from concurrent import futures
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import os
+import threading
+import time
 try:
     import urllib.parse as urlparse  # For Python 3 compat
 except ImportError:
     import urlparse
 
-from chalice import Chalice, Response
-import hca.dss
-import requests
-import yaml
-
-# If DSS_ENDPOINT is set, make sure it doesn't have a trailing /
-DSS_ENDPOINT = os.environ.get('DSS_ENDPOINT', 'https://commons-dss.ucsc-cgp-dev.org/v1')
-
-# tweak, which underpins the :class:`~hca.HCAConfig` object, will try to
-# create a config directory if one does not exist. This is fine if we're
-# running locally, but not so much if this is deployed on AWS Lambda as
-# the home directory is read-only. AWS Lambda provides /tmp as a non-persistent
-# staging area, so we set the `_user_config_home` variable to /tmp so that
-# dos-dss-lambda doesn't die when we try to instantiate :class:`~hca.dss.DSSClient`.
-hca.HCAConfig._user_config_home = '/tmp/'
-config = hca.HCAConfig(save_on_exit=False, autosave=False)
-config['DSSClient'].swagger_url = DSS_ENDPOINT + '/swagger.json'
-dss = hca.dss.DSSClient(config=config)
+# Imported first so that cold start timings include the imports below.
+from chalicelib import coldstart
+
+with coldstart.phase('import chalice'):
+    from chalice import Chalice, Response
+
+from chalicelib.cache import DSSCache
+from chalicelib.client import DSS_ENDPOINT, get_dss
+from chalicelib.encoding import dumps
+from chalicelib.index import load_index
+from chalicelib import metrics
+from chalicelib.replicas import ReplicaTracker
+from chalicelib import search as dss_search
+from chalicelib.singleflight import SingleFlight
+from chalicelib.swagger import load_swagger
+
+# The DSS client is built on first use by :func:`get_dss`, see
+# :mod:`chalicelib.client`.
+
+# Upstream lookups are fanned out over a small, bounded thread pool that lives
+# as long as the Lambda container does. Each replica lookup gets its own
+# deadline, counted from when it starts, so that a slow replica only costs us
+# its URL. All replica lookups of a request together get REPLICA_DEADLINE,
+# which keeps the request within the 29 seconds of API Gateway.
+REPLICA_TIMEOUT = float(os.environ.get('DOS_REPLICA_TIMEOUT', '5'))
+REPLICA_DEADLINE = float(os.environ.get('DOS_REPLICA_DEADLINE', '20'))
+REPLICA_WORKERS = int(os.environ.get('DOS_REPLICA_WORKERS', '8'))
+executor = futures.ThreadPoolExecutor(max_workers=REPLICA_WORKERS)
+
+# The largest number of data objects that may be resolved in one request.
+# Every bundle of those is fetched from every replica, so this is kept small
+# enough for that to fit in REPLICA_DEADLINE.
+BATCH_LIMIT = int(os.environ.get('DOS_BATCH_LIMIT', '100'))
+
+# The default number of remote-file-manifest entries in a page of a bundle
+# manifest.
+MANIFEST_PAGE_SIZE = int(os.environ.get('DOS_MANIFEST_PAGE_SIZE', '1000'))
+
+# The DSS replicas we return URLs for and look files up in.
+REPLICAS = [replica.strip() for replica in os.environ.get('DSS_REPLICAS', 'aws,azure,gcp').split(',')
+            if replica.strip()]
+# Searches, whose pages are only valid on the replica that returned them, and
+# the reference JSON of files by reference go to the first of them.
+PRIMARY_REPLICA = REPLICAS[0]
+
+# Everything else goes to the replicas that answered fastest lately, skipping
+# those that keep failing or answering later than REPLICA_TIMEOUT for
+# DOS_REPLICA_COOLDOWN seconds. See :mod:`chalicelib.replicas`.
+replica_tracker = ReplicaTracker(REPLICAS,
+                                 failure_threshold=int(os.environ.get('DOS_REPLICA_FAILURES', '5')),
+                                 cooldown=float(os.environ.get('DOS_REPLICA_COOLDOWN', '30')),
+                                 slow=REPLICA_TIMEOUT)
+
+# The URL of a file or bundle in each replica, with a placeholder for its
+# UUID, formatted once rather than for every Data Object.
+URL_TEMPLATES = {path: {replica: '{}/{}/{{}}?replica={}'.format(DSS_ENDPOINT, path, replica)
+                        for replica in REPLICAS}
+                 for path in ('files', 'bundles')}
+
+# The DSS file headers and bundle manifest keys that carry checksums, and the
+# DOS checksum type of each. Checksums DSS doesn't give us are left out.
+FILE_HEADER_CHECKSUMS = [('X-DSS-SHA256', 'sha256'), ('X-DSS-S3-ETAG', 'etag'),
+                         ('X-DSS-SHA1', 'sha1'), ('X-DSS-CRC32C', 'crc32c')]
+BUNDLE_FILE_CHECKSUMS = [('sha256', 'sha256'), ('s3_etag', 'etag'),
+                         ('sha1', 'sha1'), ('crc32c', 'crc32c')]
+# The bundle manifest key of each DOS checksum type we can filter lists on.
+# S3 ETags are what DOS calls multipart MD5s.
+CHECKSUM_FIELDS = dict([(checksum_type, key) for key, checksum_type in BUNDLE_FILE_CHECKSUMS],
+                       **{'multipart-md5': 's3_etag'})
+
+# Bundle manifests are cached per container and shared by every endpoint.
+# Set BUNDLE_CACHE_DIR (e.g. to /tmp/bundles) to also keep them on disk, up to
+# BUNDLE_CACHE_DIR_SIZE bytes, and BUNDLE_CACHE_STALE_TTL to keep serving the latest version of a bundle for
+# that many seconds after it expired while it is reloaded in the background.
+bundle_cache = DSSCache(name='bundle',
+                        max_size=int(os.environ.get('BUNDLE_CACHE_SIZE', '256')),
+                        ttl=float(os.environ.get('BUNDLE_CACHE_TTL', '300')),
+                        directory=os.environ.get('BUNDLE_CACHE_DIR') or None,
+                        max_disk_bytes=int(os.environ.get('BUNDLE_CACHE_DIR_SIZE', str(256 * 1024 * 1024))),
+                        stale_ttl=float(os.environ.get('BUNDLE_CACHE_STALE_TTL', '0')),
+                        executor=executor)
+
+# The reference JSON of files by reference never changes for a given version,
+# so it is kept around as well. Set REFERENCE_CACHE_DIR to keep it on disk, up
+# to REFERENCE_CACHE_DIR_SIZE bytes.
+reference_cache = DSSCache(name='reference',
+                           max_size=int(os.environ.get('REFERENCE_CACHE_SIZE', '4096')),
+                           ttl=float(os.environ.get('BUNDLE_CACHE_TTL', '300')),
+                           directory=os.environ.get('REFERENCE_CACHE_DIR') or None,
+                           max_disk_bytes=int(os.environ.get('REFERENCE_CACHE_DIR_SIZE', str(64 * 1024 * 1024))),
+                           stale_ttl=float(os.environ.get('BUNDLE_CACHE_STALE_TTL', '0')),
+                           executor=executor)
+
+# Identical DSS calls made at the same time, by concurrent requests or by the
+# threads of one request, are made once and share the result.
+in_flight = SingleFlight()
+
+# DSS files and bundles never change once a version is given, so responses
+# to version-pinned requests may be cached by clients and the API Gateway for
+# as long as they like. Responses for the latest version are only cached for
+# LATEST_MAX_AGE seconds, and so are ones missing replica URLs.
+PINNED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+LATEST_CACHE_CONTROL = 'public, max-age={}'.format(int(os.environ.get('DOS_LATEST_MAX_AGE', '60')))
+# Responses that list replica URLs fastest first change with the latency of
+# the replicas even for a pinned version, so they are only cached for
+# DOS_ORDERED_MAX_AGE seconds.
+ORDERED_CACHE_CONTROL = 'public, max-age={}'.format(int(os.environ.get('DOS_ORDERED_MAX_AGE', '300')))
+
+# An index of the files in DSS, see :mod:`chalicelib.index`. It is opened on
+# first use, and only if DOS_FILE_INDEX points at one.
+FILE_INDEX = os.environ.get('DOS_FILE_INDEX') or None
+_file_index = None
+_file_index_lock = threading.Lock()
 
 app = Chalice(app_name='dos-dss-lambda', debug=True)
 app.log.setLevel(logging.DEBUG)
 
 
+def instrumented(view_function):
+    """
+    Collects the metrics of every request to a route, returns them in a
+    `Server-Timing` header and logs them in CloudWatch Embedded Metric Format.
+    See :mod:`chalicelib.metrics`. Also encodes the response body as compact
+    JSON, see :mod:`chalicelib.encoding`.
+    :param view_function:
+    :return:
+    """
+    @functools.wraps(view_function)
+    def wrapper(*args, **kwargs):
+        request_metrics = metrics.begin(view_function.__name__)
+        # A view that raises is answered by Chalice with a 500.
+        status_code = 500
+        try:
+            response = view_function(*args, **kwargs)
+            if not isinstance(response, Response):
+                response = Response(body=response, status_code=200)
+            status_code = response.status_code
+        finally:
+            request_metrics.finish(status_code)
+            metrics.emit(request_metrics)
+        if not isinstance(response.body, str):
+            response.body = dumps(response.body)
+            response.headers.setdefault('Content-Type', 'application/json')
+        response.headers['Server-Timing'] = request_metrics.server_timing()
+        incomplete = request_metrics.incomplete()
+        if incomplete:
+            response.headers['Warning'] = '199 - "URLs of replicas {} may be missing"'.format(
+                ', '.join(sorted(incomplete)))
+        return response
+    return wrapper
+
+
+def call_dss(method_name, **kwargs):
+    """
+    Calls a method of the DSS client, timing it for the request's metrics
+    and for the replica tracker. If the same call is already in flight, its
+    result is shared instead.
+    :param method_name:
+    :param kwargs:
+    :return:
+    """
+    key = (method_name,) + tuple(sorted(kwargs.items()))
+    return in_flight.do(key, functools.partial(_call_dss, method_name, kwargs))
+
+
+def _call_dss(method_name, kwargs):
+    start = time.time()
+    try:
+        with metrics.timed(method_name):
+            result = getattr(get_dss(), method_name)(**kwargs)
+    except Exception as e:
+        replica_tracker.record(kwargs.get('replica'), time.time() - start, ok=not is_replica_failure(e))
+        raise
+    replica_tracker.record(kwargs.get('replica'), time.time() - start)
+    return result
+
+
+def status_code_of(e):
+    """
+    Returns the HTTP status code of the DSS response an error was raised
+    for, or None if it wasn't raised for a response.
+    :param e:
+    :return:
+    """
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+
+def is_replica_failure(e):
+    """
+    Tells whether an error raised by a DSS call means that the replica is
+    failing, rather than that the request was bad or the object is missing.
+    :param e:
+    :return:
+    """
+    status_code = status_code_of(e)
+    return status_code is None or status_code >= 500 or status_code == 429
+
+
+def available_replicas():
+    """
+    Returns the replicas that may be called, fastest first, and records the
+    ones that are being skipped as degraded, since the response won't have
+    their URLs.
+    :return:
+    """
+    available = replica_tracker.available()
+    for replica in REPLICAS:
+        if replica not in available:
+            metrics.current().record_degraded(replica)
+    return available
+
+
+def on_any_replica(fn):
+    """
+    Calls `fn(replica=...)` for the available replicas, fastest first, until
+    one doesn't fail, and returns its result. DSS replicates asynchronously,
+    so an object one replica doesn't have yet is looked for in the others
+    too. Other errors that aren't the replica's fault are raised right away.
+
+    If no replica has the object, the error of a replica that failed is
+    raised rather than its 404, since that replica may well have it.
+    :param fn:
+    :return:
+    """
+    failure = missing = None
+    for replica in replica_tracker.available():
+        try:
+            return fn(replica=replica)
+        except Exception as e:
+            if status_code_of(e) == 404:
+                missing = missing or e
+            elif is_replica_failure(e):
+                app.log.warning('Falling back from replica %s: %s', replica, e)
+                failure = e
+            else:
+                raise
+    raise failure or missing
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Runs `fn` on the shared thread pool, reporting its upstream calls to the
+    metrics of the current request.
+    :return: a :class:`~concurrent.futures.Future`
+    """
+    return executor.submit(metrics.bound(fn), *args, **kwargs)
+
+
 def dss_file_to_dos(data_object_id, dss_file):
     """
     Converts a DSS file header into a Data Object.
@@ -56,34 +290,28 @@ def dss_file_to_dos(data_object_id, dss_file):
 
     data_object = {}
     data_object['id'] = data_object_id
-    sha256 = {'checksum': dss_file.get('X-DSS-SHA256', None), 'type': 'sha256'}
-    etag = {'checksum': dss_file.get('X-DSS-S3-ETAG', None), 'type': 'etag'}
-    sha1 = {'checksum': dss_file.get('X-DSS-SHA1', None), 'type': 'sha1'}
-    crc32c = {'checksum': dss_file.get('X-DSS-CRC32C', None), 'type': 'crc32c'}
-    checksums = [sha256, etag, sha1, crc32c]
-    data_object['checksums'] = checksums
+    data_object['checksums'] = make_checksums(dss_file, FILE_HEADER_CHECKSUMS)
     data_object['version'] = dss_file.get('X-DSS-VERSION', None)
     data_object['content_type'] = dss_file.get('X-DSS-CONTENT-TYPE', None)
+    data_object['size'] = dss_file.get('X-DSS-SIZE', None)
     data_object['urls'] = make_urls(data_object_id, 'files')
     return data_object
 
 
 def dss_list_bundle_to_dos(dss_bundle):
     """
-    Converts a DSS bundle to DOS bundle messages by splitting the ID.
+    Converts a DSS bundle to DOS bundle messages by splitting the ID. If the
+    search hit carries the bundle manifest, the IDs of the files in it are
+    filled in as well.
 
     :param bundle_list:
     :return:
     """
     dos_bundle = {}
-    dos_bundle['id'] = dss_bundle['bundle_fqid'].split('.')[0]
-    dos_bundle['version'] = dss_bundle['bundle_fqid'].split('.')[1]
-    # full_bundle = requests.get(
-    #     "{}/bundles/{}?replica=aws&version={}".format(
-    #         DSS_URL, dos_bundle['id'], dos_bundle['version'])).json()
-    # if full_bundle and full_bundle.get('files', None):
-    #     for file in full_bundle.get('files'):
-    #         dos_bundle['data_object_ids'].append(file['uuid'])
+    dos_bundle['id'], dos_bundle['version'] = split_fqid(dss_bundle['bundle_fqid'])
+    files = search_hit_files(dss_bundle)
+    if files is not None:
+        dos_bundle['data_object_ids'] = [x['uuid'] for x in files]
     return dos_bundle
 
 
@@ -101,6 +329,59 @@ def dss_bundle_to_dos(dss_bundle):
     return dos_bundle
 
 
+def make_etag(*parts, **kwargs):
+    """
+    Makes an ETag from the given parts, a weak one if `weak=True` is given,
+    for responses that are equivalent but not byte for byte the same.
+    :param parts:
+    :return:
+    """
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+    return '{}"{}"'.format('W/' if kwargs.get('weak') else '', digest)
+
+
+def conditional_response(body, etag, cache_control, headers=None):
+    """
+    Returns `body` with the given validator and caching headers, or an empty
+    304 if the request already holds that representation.
+    :param body:
+    :param etag:
+    :param cache_control:
+    :param headers: any other headers of the response
+    :return:
+    """
+    headers = dict(headers or {}, ETag=etag)
+    headers['Cache-Control'] = cache_control
+    if_none_match = app.current_request.headers.get('if-none-match', None)
+    if if_none_match:
+        # If-None-Match uses the weak comparison.
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if '*' in tags or (etag[2:] if etag.startswith('W/') else etag) in tags:
+            return Response(body='', status_code=304, headers=headers)
+    return Response(body=body, status_code=200, headers=headers)
+
+
+def cache_control(version, ordered=False):
+    """
+    Returns the `Cache-Control` header for a response to a request for the
+    given version of a file or bundle, or for its latest version if None.
+    :param version:
+    :param ordered: whether the response lists replicas fastest first
+    :return:
+    """
+    if version and not metrics.current().incomplete():
+        return ORDERED_CACHE_CONTROL if ordered else PINNED_CACHE_CONTROL
+    return LATEST_CACHE_CONTROL
+
+
+# The swagger description never changes for a deployment, so it is loaded
+# once per container.
+with coldstart.phase('load swagger'):
+    SWAGGER = load_swagger()
+    SWAGGER_ETAG = make_etag(SWAGGER)
+
+
 @app.route('/swagger.json', cors=True)
 def swagger():
     """
@@ -108,25 +389,31 @@ def swagger():
 
     :return:
     """
-    # FIXME replace with one hosted here
-    req = requests.get("https://ga4gh.github.io/data-object-service-schemas/swagger/data_object_service.swagger.yaml")
-    swagger_dict = yaml.load(req.content)
-
-    swagger_dict['basePath'] = '/api/ga4gh/dos/v1'
-    return swagger_dict
+    return conditional_response(SWAGGER, SWAGGER_ETAG, 'public, max-age=3600')
 
 
 def make_urls(object_id, path):
     """
-    Makes a list of URLs for each replica for a DOS message.
+    Makes a list of URLs for each replica for a DOS message, fastest replica
+    first.
     :param object_id:
-    :param path:
+    :param path: 'files' or 'bundles'
     :return:
     """
-    replicas = ['aws', 'azure', 'gcp']
-    urls = [{'url': '{}/{}/{}?replica={}'.format(
-            DSS_ENDPOINT, path, object_id, replica)} for replica in replicas]
-    return urls
+    templates = URL_TEMPLATES[path]
+    return [{'url': templates[replica].format(object_id)} for replica in replica_tracker.ordered()]
+
+
+def make_checksums(source, table):
+    """
+    Makes the DOS checksums of a file from the DSS headers or manifest entry
+    `source`, according to `table`, leaving out those that are missing.
+    :param source:
+    :param table: a list of (key in `source`, DOS checksum type) pairs
+    :return:
+    """
+    return [{'checksum': source[key], 'type': checksum_type}
+            for key, checksum_type in table if source.get(key)]
 
 
 def convert_reference_json(reference_json, data_object):
@@ -149,97 +436,641 @@ def convert_reference_json(reference_json, data_object):
     return data_object
 
 
-@app.route('/ga4gh/dos/v1/dataobjects/{data_object_id}', methods=['GET'], cors=True)
-def get_data_object(data_object_id):
+def get_bundle(uuid, replica, version=None):
     """
-    This endpoint returns DataObjects by their identifier by proxying the
-    request to files in DSS.
-    :param data_object_id:
+    Returns the DSS bundle response for a bundle on a replica, going through
+    the bundle cache. The latest version is also cached as the version it
+    is, for later requests that pin it.
+    :param uuid:
+    :param replica:
+    :param version:
+    :return:
+    """
+    def load():
+        dss_bundle = call_dss('get_bundle', uuid=uuid, version=version, replica=replica)
+        if version is None:
+            bundle_cache.put((uuid, dss_bundle['bundle']['version'], replica), dss_bundle)
+        return dss_bundle
+    return bundle_cache.get_or_load((uuid, version, replica), load)
+
+
+def get_reference_json(uuid, version):
+    """
+    Returns the reference JSON of a file by reference, going through the
+    reference cache.
+    :param uuid:
+    :param version:
+    :return:
+    """
+    return reference_cache.get_or_load(
+        (uuid, version, PRIMARY_REPLICA),
+        lambda: call_dss('get_file', uuid=uuid, version=version, replica=PRIMARY_REPLICA))
+
+
+def get_bundle_file_urls(bundle_uuid, replica):
+    """
+    Returns a dictionary mapping the uuid of each file in a bundle to its URL
+    on a single replica.
+    :param bundle_uuid:
+    :param replica:
     :return:
     """
-    dss_response = dss.head_file(uuid=data_object_id, replica='aws')
-    dss_file = dss_response.headers
-    if not dss_response.status_code == 200:
-        return Response({'msg': 'Data Object with data_object_id {} was not found.'.format(data_object_id)}, status_code=404)
-    data_object = dss_file_to_dos(data_object_id, dss_file)
+    data_bundle = get_bundle(bundle_uuid, replica)
+    return {bundle_file['uuid']: bundle_file['url']
+            for bundle_file in data_bundle['bundle']['files'] if bundle_file.get('url')}
+
+
+def get_replica_urls(bundle_uuids, replicas):
+    """
+    Fetches every bundle from every replica concurrently, once each, and
+    returns a dictionary mapping each bundle uuid to a list with one
+    `{file uuid: url}` dictionary per replica that answered within
+    `REPLICA_TIMEOUT` of being asked, in replica order. A replica that fails
+    or is too slow is logged and left out.
+
+    Lookups that are still waiting for a thread when `REPLICA_DEADLINE` is up
+    are dropped, and their replica is recorded as degraded rather than as
+    failing.
+    :param bundle_uuids:
+    :param replicas:
+    :return:
+    """
+    started = {}
+
+    def fetch(bundle_uuid, replica):
+        started[bundle_uuid, replica] = time.time()
+        return get_bundle_file_urls(bundle_uuid, replica)
+
+    pending = collections.OrderedDict(((bundle_uuid, replica), submit(fetch, bundle_uuid, replica))
+                                      for bundle_uuid in bundle_uuids for replica in replicas)
+    deadline = time.time() + REPLICA_DEADLINE
+    timed_out = set()
+    not_done = set(pending.values())
+    while not_done:
+        now = time.time()
+        for key, future in pending.items():
+            if future in not_done and key in started and now >= started[key] + REPLICA_TIMEOUT:
+                timed_out.add(key)
+                not_done.discard(future)
+        if not not_done or now >= deadline:
+            break
+        # Wake up when the first lookup in progress runs out of time. Lookups
+        # that start meanwhile run out later.
+        wake_at = min([started[key] + REPLICA_TIMEOUT for key, future in pending.items()
+                       if future in not_done and key in started] + [deadline, now + REPLICA_TIMEOUT])
+        _, not_done = futures.wait(not_done, timeout=wake_at - now, return_when=futures.FIRST_COMPLETED)
+    urls = {bundle_uuid: [] for bundle_uuid in bundle_uuids}
+    for (bundle_uuid, replica), future in pending.items():
+        if (bundle_uuid, replica) in timed_out:
+            metrics.current().record_replica_failure(replica)
+            app.log.warning('Timed out fetching bundle %s from replica %s', bundle_uuid, replica)
+        elif not future.done():
+            future.cancel()
+            metrics.current().record_degraded(replica)
+            app.log.warning('Ran out of time to fetch bundle %s from replica %s', bundle_uuid, replica)
+        elif future.exception() is not None:
+            metrics.current().record_replica_failure(replica)
+            app.log.warning('Failed fetching bundle %s from replica %s: %s',
+                            bundle_uuid, replica, future.exception())
+        else:
+            urls[bundle_uuid].append(future.result())
+    return urls
+
+
+def get_file_index():
+    """
+    Returns the file index, or None if there is none or it can't be opened,
+    in which case everything is resolved live.
+    :return:
+    """
+    global _file_index, FILE_INDEX
+    if _file_index is None and FILE_INDEX:
+        with _file_index_lock:
+            if _file_index is None and FILE_INDEX:
+                try:
+                    with metrics.timed('load_index'):
+                        _file_index = load_index(FILE_INDEX)
+                except Exception:
+                    app.log.exception('Could not open the file index %s', FILE_INDEX)
+                    FILE_INDEX = None
+    return _file_index
+
+
+def indexed_file_to_dos(indexed_file):
+    """
+    Converts a file from the file index into a Data Object, with the URLs
+    of the file in each replica that has it, fastest replica first.
+    :param indexed_file:
+    :return:
+    """
+    data_object = dss_bundle_file_to_dos(indexed_file)
+    data_object['urls'].extend({'url': indexed_file['urls'][replica]}
+                               for replica in replica_tracker.ordered() if replica in indexed_file['urls'])
+    return data_object
+
+
+def not_found(data_object_id, reason=None):
+    msg = 'Data Object with data_object_id {} was not found.'.format(data_object_id)
+    if reason:
+        msg = '{} {}'.format(msg, reason)
+    return {'msg': msg}, 404
+
+
+def resolve_data_objects(data_object_ids, versions=None, references=None):
+    """
+    Resolves a list of data object IDs into Data Objects. Every distinct ID
+    is looked up in DSS once, and every distinct parent bundle is fetched
+    once per replica, no matter how many of the requested objects it holds.
+
+    `versions` optionally maps IDs to the version to resolve. Files by
+    reference whose reference JSON is cached for that version, and other
+    files that are in the file index, are resolved without asking DSS at all.
+
+    Returns a list of `(body, status_code)` tuples in the order of
+    `data_object_ids`, where `body` is `{'data_object': ...}` on success and
+    `{'msg': ...}` otherwise.
+    :param data_object_ids:
+    :param versions:
+    :param references: a set that the IDs of the files by reference that
+        were resolved are added to. Their URLs come from the reference JSON,
+        so they aren't ordered by replica.
+    :return:
+    """
+    versions = versions or {}
+    references = set() if references is None else references
+    unique_ids = list(collections.OrderedDict.fromkeys(data_object_ids))
+    results = {}
+    for data_object_id in unique_ids:
+        version = versions.get(data_object_id, None)
+        reference_json = reference_cache.get((data_object_id, version, PRIMARY_REPLICA)) if version else None
+        if reference_json is not None:
+            data_object = convert_reference_json(reference_json, {'id': data_object_id, 'version': version})
+            results[data_object_id] = {'data_object': data_object}, 200
+            references.add(data_object_id)
+    file_index = get_file_index()
+    if file_index is not None:
+        for data_object_id in unique_ids:
+            if data_object_id in results:
+                continue
+            indexed_file = file_index.get_file(data_object_id, versions.get(data_object_id, None))
+            # Files by reference need their reference JSON, so they are
+            # resolved live.
+            if indexed_file is not None and 'fileref' in (indexed_file['content-type'] or ''):
+                indexed_file = None
+            metrics.current().record_cache('index', indexed_file is not None)
+            if indexed_file is not None:
+                results[data_object_id] = {'data_object': indexed_file_to_dos(indexed_file)}, 200
+    heads = collections.OrderedDict(
+        (data_object_id, submit(on_any_replica, functools.partial(
+            call_dss, 'head_file', uuid=data_object_id, version=versions.get(data_object_id, None))))
+        for data_object_id in unique_ids if data_object_id not in results)
+    data_objects = {}
+    for data_object_id, future in heads.items():
+        try:
+            dss_response = future.result()
+        except Exception as e:
+            results[data_object_id] = not_found(data_object_id, str(e))
+            continue
+        if not dss_response.status_code == 200:
+            results[data_object_id] = not_found(data_object_id)
+            continue
+        dss_file = dss_response.headers
+        data_objects[data_object_id] = (dss_file_to_dos(data_object_id, dss_file), dss_file)
+
     # FIXME download the extra metadata if its a file by reference
     content_key = 'fileref'
-    if data_object['content_type'].find(content_key) != -1:
-        reference_json = dss.get_file(replica='aws', uuid=data_object_id)
+    filerefs = {data_object_id: submit(get_reference_json, data_object_id, data_object['version'])
+                for data_object_id, (data_object, _) in data_objects.items()
+                if data_object['content_type'].find(content_key) != -1}
+    for data_object_id, future in filerefs.items():
+        data_object, _ = data_objects[data_object_id]
         try:
-            data_object = convert_reference_json(reference_json, data_object)
+            data_object = convert_reference_json(future.result(), data_object)
         except Exception as e:
-            return Response({'msg': 'Data Object with data_object_id {} was not found. {}'.format(data_object_id, str(e))},
-                            status_code=404)
-    else:
-        replicas = ['aws', 'azure', 'gcp']
-        for replica in replicas:
-            # TODO make async
+            results[data_object_id] = not_found(data_object_id, str(e))
+        else:
+            results[data_object_id] = {'data_object': data_object}, 200
+            references.add(data_object_id)
+
+    bundle_uuids = set(dss_file['X-DSS-BUNDLE-UUID'] for data_object_id, (_, dss_file) in data_objects.items()
+                       if data_object_id not in filerefs)
+    bundle_urls = get_replica_urls(bundle_uuids, available_replicas()) if bundle_uuids else {}
+    for data_object_id, (data_object, dss_file) in data_objects.items():
+        if data_object_id in filerefs:
+            continue
+        for file_urls in bundle_urls[dss_file['X-DSS-BUNDLE-UUID']]:
+            if data_object_id in file_urls:
+                data_object['urls'].append({'url': file_urls[data_object_id]})
+        results[data_object_id] = {'data_object': data_object}, 200
+    return [results[data_object_id] for data_object_id in data_object_ids]
+
+
+@app.route('/ga4gh/dos/v1/dataobjects/{data_object_id}', methods=['GET'], cors=True)
+@instrumented
+def get_data_object(data_object_id):
+    """
+    This endpoint returns DataObjects by their identifier by proxying the
+    request to files in DSS. An optional `version` query parameter selects
+    the version of the file.
+    :param data_object_id:
+    :return:
+    """
+    versions = {}
+    if app.current_request.query_params and app.current_request.query_params.get('version', None):
+        versions[data_object_id] = app.current_request.query_params['version']
+    references = set()
+    body, status_code = resolve_data_objects([data_object_id], versions, references)[0]
+    if not status_code == 200:
+        return Response(body, status_code=status_code)
+    data_object = body['data_object']
+    # The URLs are part of the ETag since a replica that timed out is left out,
+    # but not their order, which only follows the latency of the replicas.
+    etag = make_etag('data_object', data_object['id'], data_object['version'], data_object['checksums'],
+                     sorted(url['url'] for url in data_object['urls']), weak=True)
+    return conditional_response(body, etag, cache_control(versions.get(data_object_id),
+                                                          ordered=data_object_id not in references))
+
+
+@app.route('/ga4gh/dos/v1/dataobjects:batch', methods=['POST'], cors=True)
+@instrumented
+def get_data_objects():
+    """
+    This endpoint resolves many DataObjects in a single request. It expects a
+    body of the form `{"data_object_ids": [...]}`, optionally along with
+    `"versions": {data_object_id: version}`, and returns
+    `{"data_objects": [...]}` in the same order, where each entry is either
+    `{"data_object": ...}` or, if that object could not be resolved,
+    `{"data_object_id": ..., "msg": ..., "status_code": ...}`.
+
+    :return:
+    """
+    req_body = app.current_request.json_body
+    data_object_ids = req_body.get('data_object_ids', None) if isinstance(req_body, dict) else None
+    if not isinstance(data_object_ids, list) or not all(isinstance(i, str) for i in data_object_ids):
+        return Response({'msg': 'Expected a list of data_object_ids.'}, status_code=400)
+    if len(data_object_ids) > BATCH_LIMIT:
+        return Response({'msg': 'At most {} data_object_ids may be requested at once.'.format(BATCH_LIMIT)},
+                        status_code=400)
+    versions = req_body.get('versions', None) or {}
+    if not isinstance(versions, dict) or not all(isinstance(version, str) for version in versions.values()):
+        return Response({'msg': 'Expected versions to map data_object_ids to versions.'}, status_code=400)
+    data_objects = []
+    for data_object_id, (body, status_code) in zip(data_object_ids, resolve_data_objects(data_object_ids, versions)):
+        if not status_code == 200:
+            body = dict(body, data_object_id=data_object_id, status_code=status_code)
+        data_objects.append(body)
+    return {'data_objects': data_objects}
+
+
+def search(per_page, search_after=None, es_query=None, output_format=None):
+    """
+    Requests one page of bundle search results from the primary replica, see
+    :func:`chalicelib.search.search`.
+    :param per_page:
+    :param search_after:
+    :param es_query:
+    :param output_format:
+    :return: the results and the `search_after` token of the next page, or
+        None if this is the last page
+    """
+    with metrics.timed('post_search'):
+        return dss_search.search(get_dss(), PRIMARY_REPLICA, per_page, search_after, es_query, output_format)
+
+
+def iter_search_pages(per_page, search_after=None, es_query=None, output_format=None):
+    """
+    Lazily walks the DSS search results starting at `search_after`. Yields
+    `(search_after, next_search_after, results)` for each page. While the
+    caller works on a page, the next page is already being fetched in the
+    background.
+    :param per_page:
+    :param search_after:
+    :param es_query:
+    :param output_format:
+    :return:
+    """
+    future = submit(search, per_page, search_after, es_query, output_format)
+    try:
+        while future is not None:
+            results, next_search_after = future.result()
+            future = None
+            if next_search_after:
+                future = submit(search, per_page, next_search_after, es_query, output_format)
+            yield search_after, next_search_after, results
+            search_after = next_search_after
+    finally:
+        # Drop the prefetch if the caller stopped before reaching it.
+        if future is not None:
+            future.cancel()
+
+
+def split_fqid(fqid):
+    """
+    Splits a DSS fully qualified ID of the form `uuid.version` into its uuid
+    and version.
+    :param fqid:
+    :return:
+    """
+    uuid, version = fqid.split('.', 1)
+    return uuid, version
+
+
+def dss_bundle_file_to_dos(dss_bundle_file):
+    """
+    Converts a file entry of a DSS bundle manifest into a Data Object.
+
+    :param dss_bundle_file:
+    :return:
+    """
+    data_object = {}
+    data_object['id'] = dss_bundle_file['uuid']
+    data_object['name'] = dss_bundle_file.get('name', None)
+    data_object['size'] = str(dss_bundle_file['size']) if 'size' in dss_bundle_file else None
+    data_object['checksums'] = make_checksums(dss_bundle_file, BUNDLE_FILE_CHECKSUMS)
+    data_object['version'] = dss_bundle_file.get('version', None)
+    data_object['content_type'] = dss_bundle_file.get('content-type', None)
+    data_object['urls'] = make_urls(data_object['id'], 'files')
+    return data_object
+
+
+def search_hit_files(result):
+    """
+    Returns the file list of the bundle manifest included in a DSS search
+    hit, or None if DSS did not include the manifest.
+    :param result:
+    :return:
+    """
+    metadata = result.get('metadata', None) or {}
+    return (metadata.get('manifest', None) or {}).get('files', None)
+
+
+def get_search_hit_files(result):
+    """
+    Returns the files of the bundle of a DSS search hit, taking them from the
+    hit itself when possible, from the file index next and from the (cached)
+    bundle otherwise.
+    :param result:
+    :return:
+    """
+    files = search_hit_files(result)
+    if files is None:
+        uuid, version = split_fqid(result['bundle_fqid'])
+        file_index = get_file_index()
+        if file_index is not None:
+            files = file_index.get_bundle_files(uuid, version)
+            metrics.current().record_cache('index', files is not None)
+    if files is None:
+        files = on_any_replica(functools.partial(get_bundle, uuid, version=version))['bundle']['files']
+    return files
+
+
+def iter_data_object_pages(search_after=None, es_query=None, predicate=None):
+    """
+    Lazily walks the pages of raw DSS search results, which carry the
+    manifests of their bundles. Yields `(search_after, next_search_after,
+    data_objects)` for each page, where `data_objects` lazily expands the
+    bundles of the page into the Data Objects they contain, or only those
+    whose file satisfies `predicate`, see :func:`iter_hit_data_objects`.
+    :param search_after:
+    :param es_query:
+    :param predicate:
+    :return:
+    """
+    for search_after, next_search_after, results in iter_search_pages(
+            dss_search.MAX_RAW_PER_PAGE, search_after, es_query, output_format='raw'):
+        yield search_after, next_search_after, iter_hit_data_objects(results, predicate)
+
+
+def iter_hit_data_objects(results, predicate=None):
+    """
+    Lazily yields the Data Objects of the bundles of a page of DSS search
+    hits, or only those whose file satisfies `predicate`. Bundles whose hit
+    lacks the manifest are only fetched once they are reached, together with
+    those of the rest of the page. Bundles that can't be fetched are logged
+    and skipped.
+    :param results:
+    :param predicate:
+    :return:
+    """
+    pending = {}
+    for i, result in enumerate(results):
+        files = search_hit_files(result)
+        if files is None:
+            if not pending:
+                pending = {j: submit(get_search_hit_files, hit) for j, hit in enumerate(results)
+                           if j >= i and search_hit_files(hit) is None}
             try:
-                data_bundle = dss.get_bundle(uuid=dss_file['X-DSS-BUNDLE-UUID'], replica=replica)
-                url = filter(lambda x: x['uuid'] == data_object_id, data_bundle.json()['bundle']['files'])[0]['url']
-                data_object['urls'].append({'url': url})
+                files = pending[i].result()
             except Exception as e:
-                pass
-    return {'data_object': data_object}
+                app.log.warning('Skipping bundle %s that could not be fetched: %s', result['bundle_fqid'], e)
+                continue
+        for bundle_file in files:
+            if predicate is None or predicate(bundle_file):
+                yield dss_bundle_file_to_dos(bundle_file)
+
+
+def make_list_filters(params):
+    """
+    Translates the filters of a DOS list request into an Elasticsearch query
+    for DSS that selects the bundles with a matching file, along with a
+    predicate that selects the matching files of a bundle manifest. The query
+    alone isn't enough to select files since different filters may match
+    different files of a bundle.
+
+    DSS has no aliases, so the name of a file in its bundle is used instead.
+    Only DSS file URLs can be filtered on. Raises a ValueError for filters
+    that can't be translated.
+
+    :param params: the query parameters of the request
+    :return: the query and the predicate, or `{}` and None if there are no
+        filters
+    """
+    params = params or {}
+    clauses = []
+    predicates = []
+    alias = params.get('alias', None)
+    if alias:
+        clauses.append({'match': {'manifest.files.name': alias}})
+        predicates.append(lambda bundle_file: bundle_file.get('name') == alias)
+    checksum = params.get('checksum', None)
+    checksum_type = params.get('checksum_type', None)
+    if checksum_type:
+        if checksum_type not in CHECKSUM_FIELDS:
+            raise ValueError('Unsupported checksum_type {}, use one of {}.'.format(
+                checksum_type, ', '.join(sorted(CHECKSUM_FIELDS))))
+        fields = [CHECKSUM_FIELDS[checksum_type]]
+    else:
+        fields = sorted(set(CHECKSUM_FIELDS.values()))
+    if checksum:
+        clauses.append({'bool': {'should': [{'match': {'manifest.files.' + field: checksum}} for field in fields],
+                                 'minimum_should_match': 1}})
+        predicates.append(lambda bundle_file: any((bundle_file.get(field) or '').lower() == checksum.lower()
+                                                  for field in fields))
+    elif checksum_type:
+        clauses.append({'exists': {'field': 'manifest.files.' + fields[0]}})
+        predicates.append(lambda bundle_file: bool(bundle_file.get(fields[0])))
+    url = params.get('url', None)
+    if url:
+        files_url = '{}/files/'.format(DSS_ENDPOINT)
+        if not url.startswith(files_url):
+            raise ValueError('Only DSS file URLs starting with {} can be filtered on.'.format(files_url))
+        file_uuid = urlparse.urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+        clauses.append({'match': {'manifest.files.uuid': file_uuid}})
+        predicates.append(lambda bundle_file: bundle_file['uuid'] == file_uuid)
+    content_type = params.get('content_type', None)
+    if content_type:
+        clauses.append({'match_phrase': {'manifest.files.content-type': content_type}})
+        predicates.append(lambda bundle_file: (bundle_file.get('content-type') or '').startswith(content_type))
+    if not clauses:
+        return {}, None
+    return ({'query': {'bool': {'must': clauses}}},
+            lambda bundle_file: all(predicate(bundle_file) for predicate in predicates))
+
+
+def parse_page_size(params, default):
+    """
+    Returns the `page_size` query parameter as a positive integer, or
+    `default` if it wasn't given. Raises a ValueError otherwise.
+    :param params: the query parameters of the request
+    :param default:
+    :return:
+    """
+    page_size = (params or {}).get('page_size', None)
+    if not page_size:
+        return default
+    try:
+        page_size = int(page_size)
+    except ValueError:
+        raise ValueError('Invalid page_size {}, expected an integer.'.format(page_size))
+    if page_size < 1:
+        raise ValueError('Invalid page_size {}, expected at least 1.'.format(page_size))
+    return page_size
+
+
+def encode_page_token(search_after, offset):
+    """
+    The data object pages we serve don't line up with the pages of bundles
+    DSS returns, so our page tokens hold the DSS `search_after` token of a
+    page of bundles plus an offset into the data objects of that page.
+    :param search_after:
+    :param offset:
+    :return:
+    """
+    token = json.dumps({'search_after': search_after, 'offset': offset})
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('utf-8')
+
+
+def decode_page_token(page_token):
+    token = json.loads(base64.urlsafe_b64decode(page_token.encode('utf-8')).decode('utf-8'))
+    return token['search_after'], int(token['offset'])
 
 
 @app.route('/ga4gh/dos/v1/dataobjects', methods=['GET'], cors=True)
+@instrumented
 def list_data_objects():
     """
     This endpoint translates DOS List requests into requests against DSS
-    and converts the responses into GA4GH messages.
+    and converts the responses into GA4GH messages. DSS only lists bundles,
+    so each bundle is expanded into the Data Objects it contains. Bundles
+    are searched for a page of raw search hits at a time, independently of
+    `page_size`, and only as many of them as the page needs are expanded.
 
     :return:
     """
-    return Response(body='', status_code=405)
+    req_body = app.current_request.query_params
+    search_after = None
+    offset = 0
+    next_page_token = None
+    try:
+        per_page = parse_page_size(req_body, 10)
+    except ValueError as e:
+        return Response({'msg': str(e)}, status_code=400)
+    if req_body and req_body.get('page_token', None):
+        try:
+            search_after, offset = decode_page_token(req_body['page_token'])
+        except Exception:
+            return Response({'msg': 'Invalid page_token {}.'.format(req_body['page_token'])}, status_code=400)
+    try:
+        es_query, predicate = make_list_filters(req_body)
+    except ValueError as e:
+        return Response({'msg': str(e)}, status_code=400)
+    data_objects = []
+    pages = iter_data_object_pages(search_after, es_query, predicate)
+    for search_after, next_search_after, page in pages:
+        page = itertools.islice(page, offset, None)
+        taken = list(itertools.islice(page, per_page - len(data_objects)))
+        data_objects.extend(taken)
+        if len(data_objects) == per_page:
+            if next(page, None) is not None:
+                next_page_token = encode_page_token(search_after, offset + len(taken))
+            elif next_search_after:
+                next_page_token = encode_page_token(next_search_after, 0)
+            break
+        offset = 0
+    pages.close()
+    return {'data_objects': data_objects, 'next_page_token': next_page_token}
 
 
 @app.route('/ga4gh/dos/v1/databundles', methods=['GET'], cors=True)
+@instrumented
 def list_data_bundles():
     """
     This endpoint translates DOS List requests into requests against DSS
     and converts the responses into GA4GH messages.
 
+    Pages of bundles are pages of DSS search results, so `page_size` must be
+    in the range DSS accepts.
+
+    With `expand=true` each bundle also lists its `data_object_ids`, taken
+    from the bundle manifests that DSS includes in raw search hits, for
+    pages small enough to be searched for raw hits. Bundles whose hit lacks
+    the manifest are fetched concurrently. A bundle that cannot be fetched
+    is listed with a `msg` and `status_code` instead of its
+    `data_object_ids`.
+
     :return:
     """
     req_body = app.current_request.query_params
-    per_page = 10
     page_token = None
-    next_page_token = None
-    if req_body and req_body.get('page_size', None):
-        per_page = req_body['page_size']
+    expand = False
+    try:
+        per_page = parse_page_size(req_body, 10)
+    except ValueError as e:
+        return Response({'msg': str(e)}, status_code=400)
     if req_body and req_body.get('page_token', None):
         page_token = req_body['page_token']
-    # We use DSSClient().post_search._request to expose the underlying
-    # :class:`~requests.Request` object so that we can access the pagination
-    # headers. :func:`~DSSClient().post_search._request` is undocumented.
-    # The source code for the method is here:
-    # https://github.com/HumanCellAtlas/dcp-cli/blob/aa811490d3c680018f6c1abeef3292098556b0ea/hca/util/__init__.py#L119
-    if page_token:
-        res = dss.post_search._request(dict(replica='aws', per_page=per_page,
-                                            search_after=page_token, es_query={}))
-    else:
-        res = dss.post_search._request(dict(replica='aws', per_page=per_page, es_query={}))
-    # We need to page using the github style
-    if res.links.get('next', None):
-        # first search_after item of the query string in the link
-        # header of the response
-        next_page_token = urlparse.parse_qs(
-            urlparse.urlparse(
-                res.links['next']['url']).query)['search_after'][0]
+    if req_body and req_body.get('expand', None):
+        expand = req_body['expand'].lower() == 'true'
+    try:
+        es_query, _ = make_list_filters(req_body)
+    except ValueError as e:
+        return Response({'msg': str(e)}, status_code=400)
+    if not dss_search.MIN_PER_PAGE <= per_page <= dss_search.MAX_PER_PAGE:
+        return Response({'msg': 'Invalid page_size {}, expected {} to {} data bundles.'.format(
+            per_page, dss_search.MIN_PER_PAGE, dss_search.MAX_PER_PAGE)}, status_code=400)
+    raw = expand and per_page <= dss_search.MAX_RAW_PER_PAGE
+    results, next_page_token = search(per_page, page_token, es_query, output_format='raw' if raw else None)
     # And convert the fqid message into a DOS id and version
     response = {}
     response['next_page_token'] = next_page_token
-    try:
-        response['data_bundles'] = list(map(dss_list_bundle_to_dos, res.json()['results']))
-    except Exception as e:
-        response = e
-    finally:
-        return response
+    response['data_bundles'] = list(map(dss_list_bundle_to_dos, results))
+    if expand:
+        unexpanded = [(dos_bundle, result) for dos_bundle, result in zip(response['data_bundles'], results)
+                      if 'data_object_ids' not in dos_bundle]
+        pending = [submit(get_search_hit_files, result) for _, result in unexpanded]
+        for (dos_bundle, _), future in zip(unexpanded, pending):
+            try:
+                dos_bundle['data_object_ids'] = [x['uuid'] for x in future.result()]
+            except Exception as e:
+                app.log.warning('Failed to expand bundle %s: %s', dos_bundle['id'], e)
+                dos_bundle['msg'] = 'Data Bundle with data_bundle_id {} could not be expanded. {}'.format(
+                    dos_bundle['id'], e)
+                dos_bundle['status_code'] = status_code_of(e) or 502
+    return response
 
 
 @app.route('/ga4gh/dos/v1/databundles/{data_bundle_id}', methods=['GET'], cors=True)
+@instrumented
 def get_data_bundle(data_bundle_id):
     """
     This endpoint translates DOS List requests into requests against DSS
@@ -250,8 +1081,129 @@ def get_data_bundle(data_bundle_id):
     version = None
     if app.current_request.query_params:
         version = app.current_request.query_params.get('version', None)
-    bdl = dss.get_bundle(version=version, replica='aws', uuid=data_bundle_id)
-    return {'data_bundle': dss_bundle_to_dos(bdl['bundle'])}
+    try:
+        bdl = on_any_replica(functools.partial(get_bundle, data_bundle_id, version=version))
+    except Exception as e:
+        if is_replica_failure(e):
+            raise
+        return Response({'msg': 'Data Bundle with data_bundle_id {} was not found. {}'.format(data_bundle_id, e)},
+                        status_code=status_code_of(e))
+    data_bundle = dss_bundle_to_dos(bdl['bundle'])
+    etag = make_etag('data_bundle', data_bundle['id'], data_bundle['version'],
+                     [(f['uuid'], f.get('version'), f.get('sha256')) for f in bdl['bundle']['files']])
+    return conditional_response({'data_bundle': data_bundle}, etag, cache_control(version))
+
+
+def dss_bundle_file_to_rfm(dss_bundle_file, replica, reference_json=None):
+    """
+    Converts a file entry of a DSS bundle manifest into a remote-file-manifest
+    entry, as understood by bdbag, that points at that version of the file
+    in `replica`. Files by reference point at the file they reference, given
+    their `reference_json`.
+
+    :param dss_bundle_file:
+    :param replica:
+    :param reference_json:
+    :return:
+    """
+    entry = {'filename': dss_bundle_file.get('name') or dss_bundle_file['uuid']}
+    if reference_json is None:
+        entry['url'] = '{}&version={}'.format(URL_TEMPLATES['files'][replica].format(dss_bundle_file['uuid']),
+                                              dss_bundle_file['version'])
+        entry['length'] = dss_bundle_file['size']
+        checksums = make_checksums(dss_bundle_file, BUNDLE_FILE_CHECKSUMS)
+    else:
+        entry['url'] = reference_json['url'][0]
+        entry['length'] = reference_json['size']
+        checksums = make_checksums(reference_json, [('crc32c', 'crc32c')])
+    entry.update((checksum['type'], checksum['checksum']) for checksum in checksums)
+    return entry
+
+
+def encode_manifest_token(version, offset):
+    """
+    The page tokens of a bundle manifest pin the version of the bundle the
+    first page was served from, so that the pages add up even if a new
+    version is added meanwhile.
+    :param version:
+    :param offset:
+    :return:
+    """
+    token = json.dumps({'version': version, 'offset': offset})
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('utf-8')
+
+
+def decode_manifest_token(page_token):
+    token = json.loads(base64.urlsafe_b64decode(page_token.encode('utf-8')).decode('utf-8'))
+    return token['version'], int(token['offset'])
+
+
+@app.route('/ga4gh/dos/v1/databundles/{data_bundle_id}/manifest', methods=['GET'], cors=True)
+@instrumented
+def get_data_bundle_manifest(data_bundle_id):
+    """
+    This endpoint returns a remote-file-manifest for the files of a bundle as
+    newline delimited JSON, one entry per line, so that a BDBag of a bundle
+    can be made without resolving each of its Data Objects. Sizes and
+    checksums are taken from the bundle manifest; only files by reference
+    are looked up in DSS.
+
+    At most `page_size` entries are returned. If there are more, the `Link`
+    header points to the next page. If a file by reference on the page can't
+    be resolved, the page is answered with a 502 naming that file.
+
+    :param data_bundle_id:
+    :return:
+    """
+    req_body = app.current_request.query_params or {}
+    version = req_body.get('version', None)
+    offset = 0
+    try:
+        per_page = parse_page_size(req_body, MANIFEST_PAGE_SIZE)
+    except ValueError as e:
+        return Response({'msg': str(e)}, status_code=400)
+    if req_body.get('page_token', None):
+        try:
+            version, offset = decode_manifest_token(req_body['page_token'])
+        except Exception:
+            return Response({'msg': 'Invalid page_token {}.'.format(req_body['page_token'])}, status_code=400)
+    try:
+        dss_bundle = on_any_replica(functools.partial(get_bundle, data_bundle_id, version=version))['bundle']
+    except Exception as e:
+        if is_replica_failure(e):
+            raise
+        return Response({'msg': 'Data Bundle with data_bundle_id {} was not found. {}'.format(data_bundle_id, e)},
+                        status_code=status_code_of(e))
+    page = dss_bundle['files'][offset:offset + per_page]
+    replica = replica_tracker.ordered()[0]
+    filerefs = {dss_file['uuid']: submit(get_reference_json, dss_file['uuid'], dss_file['version'])
+                for dss_file in page if 'fileref' in dss_file.get('content-type', '')}
+    entries = []
+    for dss_file in page:
+        reference_json = None
+        if dss_file['uuid'] in filerefs:
+            try:
+                reference_json = filerefs[dss_file['uuid']].result()
+            except Exception as e:
+                # An entry can't be left out without the bag silently missing
+                # a file, so the whole page fails.
+                app.log.warning('Could not resolve file by reference %s of bundle %s: %s',
+                                dss_file['uuid'], data_bundle_id, e)
+                msg = 'The file by reference {} of data_bundle_id {} could not be resolved. {}'.format(
+                    dss_file['uuid'], data_bundle_id, e)
+                return Response({'msg': msg}, status_code=502)
+        entries.append(dss_bundle_file_to_rfm(dss_file, replica, reference_json))
+    body = ''.join(dumps(entry) + '\n' for entry in entries)
+    headers = {'Content-Type': 'application/x-ndjson'}
+    if offset + per_page < len(dss_bundle['files']):
+        # Relative to this page, and so to wherever the API is deployed.
+        headers['Link'] = '<manifest?{}>; rel="next"'.format(urlparse.urlencode({
+            'page_size': per_page, 'page_token': encode_manifest_token(dss_bundle['version'], offset + per_page)}))
+    # Entries point at the fastest replica, which may change, but a page of a
+    # version of a bundle is otherwise always the same.
+    etag = make_etag('manifest', dss_bundle['uuid'], dss_bundle['version'], offset, per_page,
+                     sorted(filerefs), weak=True)
+    return conditional_response(body, etag, cache_control(version, ordered=True), headers)
 
 
 @app.route('/')
@@ -260,3 +1212,6 @@ def index():
     return Response(body=message,
                     status_code=200,
                     headers={'Content-Type': 'text/html'})
+
+
+coldstart.report()
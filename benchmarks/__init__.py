@@ -0,0 +1,3 @@
+"""
+Reproducible load tests for dos-dss-lambda against a local fake DSS.
+"""
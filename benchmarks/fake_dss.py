@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the DSS API, for reproducible benchmarks.
+
+It serves a synthetic catalog of bundles and files through the handful of DSS
+endpoints dos-dss-lambda uses:
+
+    GET  /v1/swagger.json
+    HEAD /v1/files/{uuid}
+    GET  /v1/files/{uuid}
+    GET  /v1/bundles/{uuid}
+    POST /v1/search
+
+Every request can be delayed by a configurable latency (per replica, if
+needed) and fail with a configurable error rate, so that the effect of slow
+or flaky upstreams can be measured. Files and bundles can also be kept from
+some replicas, as if they hadn't been replicated there yet. Run it on its own with
+
+    python -m benchmarks.fake_dss --port 8001 --latency 50
+
+and point dos-dss-lambda at it with DSS_ENDPOINT=http://localhost:8001/v1.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import urllib.parse as urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import urlparse
+
+VERSION = '2018-06-07T001704.000000Z'
+NAMESPACE = uuid.UUID('6ba7b811-9dad-11d1-80b4-00c04fd430c8')
+
+
+def make_uuid(*parts):
+    return str(uuid.uuid5(NAMESPACE, '/'.join(str(part) for part in parts)))
+
+
+class Catalog(object):
+    """
+    A deterministic catalog of `n_bundles` bundles with `files_per_bundle`
+    files each. Every `fileref_every`-th file is a file by reference.
+    """
+
+    def __init__(self, n_bundles=100, files_per_bundle=5, fileref_every=0):
+        self.bundles = {}
+        self.files = {}
+        for b in range(n_bundles):
+            bundle_uuid = make_uuid('bundle', b)
+            files = []
+            for f in range(files_per_bundle):
+                file_uuid = make_uuid('file', b, f)
+                fileref = fileref_every and (b * files_per_bundle + f) % fileref_every == 0
+                dss_file = {
+                    'uuid': file_uuid,
+                    'version': VERSION,
+                    'name': 'file_{}.json'.format(f),
+                    'size': 1024 * (f + 1),
+                    'content-type': 'application/json; dss-type=fileref' if fileref else 'application/json',
+                    'indexed': f == 0,
+                    'crc32c': '{:08x}'.format(f),
+                    's3_etag': make_uuid('etag', b, f).replace('-', ''),
+                    'sha1': make_uuid('sha1', b, f).replace('-', '') + '00000000',
+                    'sha256': (make_uuid('sha256', b, f) * 2).replace('-', '')[:64],
+                }
+                files.append(dss_file)
+                self.files[file_uuid] = (bundle_uuid, dss_file)
+            self.bundles[bundle_uuid] = {'uuid': bundle_uuid, 'version': VERSION, 'files': files,
+                                         'creator_uid': 0}
+        self.bundle_order = sorted(self.bundles)
+
+
+def swagger(host):
+    """
+    Returns a swagger description of the fake endpoints, detailed enough for
+    :class:`~hca.dss.DSSClient` to build its methods from.
+    """
+    def method(summary, parameters, responses=('200',)):
+        return {'summary': summary, 'description': summary, 'parameters': parameters,
+                'responses': {code: {'description': code} for code in responses}}
+
+    uuid_param = {'name': 'uuid', 'in': 'path', 'required': True, 'type': 'string'}
+    replica = {'name': 'replica', 'in': 'query', 'required': True, 'type': 'string'}
+    version = {'name': 'version', 'in': 'query', 'required': False, 'type': 'string'}
+    return {
+        'swagger': '2.0',
+        'info': {'title': 'fake DSS', 'version': '0', 'description': 'A local stand-in for DSS.'},
+        'host': host,
+        'basePath': '/v1',
+        'paths': {
+            '/files/{uuid}': {
+                'head': method('Head a file.', [uuid_param, replica, version]),
+                'get': method('Get a file.', [uuid_param, replica, version]),
+            },
+            '/bundles/{uuid}': {
+                'get': method('Get a bundle.', [uuid_param, replica, version]),
+            },
+            '/search': {
+                'post': method('Search bundles.', [
+                    replica,
+                    {'name': 'per_page', 'in': 'query', 'required': False, 'type': 'integer'},
+                    {'name': 'search_after', 'in': 'query', 'required': False, 'type': 'string'},
+                    {'name': 'output_format', 'in': 'query', 'required': False, 'type': 'string'},
+                    {'name': 'body', 'in': 'body', 'required': True, 'schema': {
+                        'type': 'object', 'required': ['es_query'],
+                        'properties': {'es_query': {'type': 'object', 'description': 'The query.'}}}}],
+                    responses=('200', '206')),
+            },
+        },
+    }
+
+
+class FakeDSSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def dss(self):
+        return self.server.dss
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        query = {k: v[0] for k, v in urlparse.parse_qs(url.query).items()}
+        return url.path, query
+
+    def _send(self, status, body=None, headers=None, head=False):
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(payload)
+
+    def _delay_or_fail(self, query):
+        """
+        Applies the injected latency and errors. Returns True if the request
+        was answered with an error.
+        """
+        self.dss.count(self.command, self._parse()[0])
+        replica = query.get('replica', 'aws')
+        latency = self.dss.latency.get(replica, self.dss.default_latency)
+        if latency:
+            time.sleep(max(0, random.gauss(latency, latency * self.dss.jitter)) / 1000.0)
+        if self.dss.error_rate and random.random() < self.dss.error_rate:
+            self._send(503, {'code': 'service_unavailable', 'title': 'Injected error'},
+                       head=self.command == 'HEAD')
+            return True
+        return False
+
+    def _missing(self, parts, query):
+        return len(parts) == 3 and parts[2] in self.dss.missing.get(query.get('replica', 'aws'), ())
+
+    def do_HEAD(self):
+        path, query = self._parse()
+        if self._delay_or_fail(query):
+            return
+        parts = path.strip('/').split('/')
+        if self._missing(parts, query):
+            return self._send(404, head=True)
+        if len(parts) == 3 and parts[1] == 'files' and parts[2] in self.dss.catalog.files:
+            bundle_uuid, dss_file = self.dss.catalog.files[parts[2]]
+            headers = {
+                'X-DSS-BUNDLE-UUID': bundle_uuid,
+                'X-DSS-VERSION': dss_file['version'],
+                'X-DSS-CONTENT-TYPE': dss_file['content-type'],
+                'X-DSS-SIZE': str(dss_file['size']),
+                'X-DSS-CRC32C': dss_file['crc32c'],
+                'X-DSS-S3-ETAG': dss_file['s3_etag'],
+                'X-DSS-SHA1': dss_file['sha1'],
+                'X-DSS-SHA256': dss_file['sha256'],
+            }
+            return self._send(200, headers=headers, head=True)
+        self._send(404, head=True)
+
+    def do_GET(self):
+        path, query = self._parse()
+        parts = path.strip('/').split('/')
+        if parts == ['v1', 'swagger.json']:
+            return self._send(200, swagger(self.headers.get('Host')))
+        if self._delay_or_fail(query):
+            return
+        if self._missing(parts, query):
+            return self._send(404, {'code': 'not_found', 'title': 'Not found'})
+        if len(parts) == 3 and parts[1] == 'files' and parts[2] in self.dss.catalog.files:
+            _, dss_file = self.dss.catalog.files[parts[2]]
+            return self._send(200, {
+                'content-type': 'application/octet-stream',
+                'crc32c': dss_file['crc32c'],
+                'size': dss_file['size'],
+                'url': ['gs://fake-bucket/' + dss_file['uuid'], 's3://fake-bucket/' + dss_file['uuid']]})
+        if len(parts) == 3 and parts[1] == 'bundles' and parts[2] in self.dss.catalog.bundles:
+            bundle = self.dss.catalog.bundles[parts[2]]
+            replica = query.get('replica', 'aws')
+            files = [dict(f, url='{}://fake-{}/{}'.format(
+                {'aws': 's3', 'gcp': 'gs'}.get(replica, 'https'), replica, f['uuid'])) for f in bundle['files']]
+            return self._send(200, {'bundle': dict(bundle, files=files)})
+        self._send(404, {'code': 'not_found', 'title': 'Not found'})
+
+    def do_POST(self):
+        path, query = self._parse()
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self._delay_or_fail(query):
+            return
+        if path.rstrip('/') != '/v1/search':
+            return self._send(404, {'code': 'not_found', 'title': 'Not found'})
+        per_page = int(query.get('per_page', 100))
+        # The limits DSS puts on the page size
+        if not 10 <= per_page <= (10 if query.get('output_format') == 'raw' else 500):
+            return self._send(400, {'code': 'illegal_arguments', 'title': 'Invalid per_page {}'.format(per_page)})
+        start = int(query.get('search_after', 0))
+        order = self.dss.catalog.bundle_order
+        results = [{'bundle_fqid': '{}.{}'.format(bundle_uuid, VERSION), 'search_score': None}
+                   for bundle_uuid in order[start:start + per_page]]
+        if query.get('output_format') == 'raw':
+            for result, bundle_uuid in zip(results, order[start:start + per_page]):
+                bundle = self.dss.catalog.bundles[bundle_uuid]
+                result['metadata'] = {'manifest': {'version': VERSION, 'files': bundle['files']}}
+        headers = {}
+        status = 200
+        if start + per_page < len(order):
+            status = 206
+            next_query = dict(query, search_after=str(start + per_page))
+            headers['Link'] = '<http://{}{}?{}>; rel="next"'.format(
+                self.headers.get('Host'), path, urlparse.urlencode(next_query))
+        self._send(status, {'es_query': {}, 'results': results, 'total_hits': len(order)}, headers=headers)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDSS(object):
+    """
+    Runs the fake DSS on a background thread. Use as a context manager, or
+    call `start` and `stop`. `missing` maps replicas to the UUIDs of the
+    files and bundles they answer 404 for.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, catalog=None, latency=0, replica_latency=None,
+                 jitter=0.1, error_rate=0.0, missing=None):
+        self.catalog = catalog or Catalog()
+        self.default_latency = latency
+        self.latency = dict(replica_latency or {})
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.missing = dict(missing or {})
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), FakeDSSHandler)
+        self.server.dss = self
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    def count(self, method, path):
+        kind = '{} {}'.format(method, '/'.join(path.strip('/').split('/')[:2]))
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+_shared = None
+
+
+def shared():
+    """
+    Returns a fake DSS that runs for the rest of the process, pointing
+    DSS_ENDPOINT at it. dos-dss-lambda reads DSS_ENDPOINT once, when it is
+    imported, so tests that import it share this one and swap its `catalog`.
+    """
+    global _shared
+    if _shared is None:
+        _shared = FakeDSS(catalog=Catalog(0)).start()
+        os.environ['DSS_ENDPOINT'] = _shared.endpoint
+    return _shared
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--bundles', type=int, default=100)
+    parser.add_argument('--files-per-bundle', type=int, default=5)
+    parser.add_argument('--fileref-every', type=int, default=0,
+                        help='make every n-th file a file by reference')
+    parser.add_argument('--latency', type=float, default=0, help='mean latency in ms')
+    parser.add_argument('--replica-latency', action='append', default=[], metavar='REPLICA=MS',
+                        help='mean latency of a single replica, e.g. azure=300')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    dss = FakeDSS(args.host, args.port,
+                  catalog=Catalog(args.bundles, args.files_per_bundle, args.fileref_every),
+                  latency=args.latency,
+                  replica_latency=dict((r, float(ms)) for r, ms in (x.split('=') for x in args.replica_latency)),
+                  error_rate=args.error_rate)
+    print('Fake DSS listening on {}'.format(dss.endpoint))
+    try:
+        dss.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
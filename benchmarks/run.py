@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Load tests dos-dss-lambda and the remote_to_bag pipeline against a local fake
+DSS (see :mod:`benchmarks.fake_dss`), at a set of concurrency levels, and
+reports throughput and p50/p95/p99 latencies.
+
+    python -m benchmarks.run --latency 50 --concurrency 1 8 32
+
+By default the lambda is served in-process by chalice's local server.
+Pass --service-url to benchmark an already running `chalice local` or a
+deployment instead, and --dss-endpoint to use an existing DSS.
+
+Run it before and after a change with --output to keep the results for
+review.
+"""
+import argparse
+from concurrent import futures
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from benchmarks.fake_dss import Catalog, FakeDSS
+
+BASE_URL = 'ga4gh/dos/v1'
+
+
+def percentile(sorted_values, p):
+    """
+    Returns the `p`th percentile of `sorted_values` by the nearest-rank method.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(name, concurrency, latencies, errors, elapsed, n_items=None):
+    latencies = sorted(latencies)
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round((n_items if n_items is not None else len(latencies)) / elapsed, 1) if elapsed else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def load(name, session, make_request, n_requests, concurrency):
+    """
+    Issues `n_requests` requests made by `make_request(i)` from `concurrency`
+    threads and summarizes their latencies.
+    """
+    def timed(i):
+        method, url, kwargs = make_request(i)
+        start = time.time()
+        r = session.request(method, url, **kwargs)
+        return time.time() - start, r.status_code < 400
+
+    start = time.time()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(n_requests)))
+    elapsed = time.time() - start
+    return summarize(name, concurrency, [r[0] for r in results],
+                     sum(1 for r in results if not r[1]), elapsed)
+
+
+def lambda_scenarios(service_url, catalog):
+    """
+    Returns the scenarios that exercise the lambda's endpoints, as functions
+    of a request index that return the request to make.
+    """
+    file_ids = sorted(catalog.files)
+    bundle_ids = catalog.bundle_order
+    base = '{}/{}'.format(service_url.rstrip('/'), BASE_URL)
+    rng = random.Random(0)
+    return [
+        ('get_data_object', lambda i: ('GET', '{}/dataobjects/{}'.format(base, rng.choice(file_ids)), {})),
+        ('get_data_objects_batch_50', lambda i: ('POST', '{}/dataobjects:batch'.format(base), {
+            'json': {'data_object_ids': rng.sample(file_ids, min(50, len(file_ids)))}})),
+        ('get_data_bundle', lambda i: ('GET', '{}/databundles/{}'.format(base, rng.choice(bundle_ids)), {})),
+        ('list_data_bundles_expand', lambda i: ('GET', '{}/databundles'.format(base), {
+            'params': {'page_size': 10, 'expand': 'true'}})),
+        ('list_data_objects', lambda i: ('GET', '{}/dataobjects'.format(base), {'params': {'page_size': 50}})),
+    ]
+
+
+def bench_remote_to_bag(service_url, catalog, concurrency):
+    """
+    Builds a remote-file-manifest for the whole catalog and summarizes the
+    latencies of the requests the pipeline makes.
+    """
+    import remote_to_bag
+    from chalicelib.sessions import get_session
+
+    latencies = []
+    lock = threading.Lock()
+
+    def record(r, *args, **kwargs):
+        with lock:
+            latencies.append(r.elapsed.total_seconds())
+
+    session = get_session()
+    session.hooks['response'].append(record)
+    failures = []
+    start = time.time()
+    try:
+        n_entries = sum(1 for _ in remote_to_bag.iter_rfm_entries(
+            [{'id': bundle_id} for bundle_id in catalog.bundle_order], service_url, BASE_URL,
+            workers=concurrency, failures=failures))
+    finally:
+        session.hooks['response'].remove(record)
+    elapsed = time.time() - start
+    # Throughput counts RFM entries rather than requests.
+    return summarize('remote_to_bag', concurrency, latencies, len(failures), elapsed, n_items=n_entries)
+
+
+def serve_lambda():
+    """
+    Serves the lambda with chalice's local server on a background thread and
+    returns its URL.
+    """
+    from chalice.config import Config
+    from chalice.local import LocalDevServer
+    import app
+
+    server = LocalDevServer(app.app, Config(), host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server.server_port)
+
+
+def print_table(results):
+    columns = ['scenario', 'concurrency', 'requests', 'errors', 'seconds', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms']
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print('  '.join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency level')
+    parser.add_argument('--scenario', action='append', default=None,
+                        help='only run the named scenarios (default: all)')
+    parser.add_argument('--bundles', type=int, default=100)
+    parser.add_argument('--files-per-bundle', type=int, default=5)
+    parser.add_argument('--fileref-every', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=20, help='mean fake DSS latency in ms')
+    parser.add_argument('--replica-latency', action='append', default=[], metavar='REPLICA=MS')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--dss-endpoint', help='use this DSS instead of a local fake one')
+    parser.add_argument('--service-url', help='benchmark this lambda instead of serving one in-process')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    catalog = Catalog(args.bundles, args.files_per_bundle, args.fileref_every)
+    dss = None
+    if not args.dss_endpoint:
+        dss = FakeDSS(catalog=catalog, latency=args.latency, error_rate=args.error_rate,
+                      replica_latency=dict((r, float(ms)) for r, ms in
+                                           (x.split('=') for x in args.replica_latency))).start()
+        args.dss_endpoint = dss.endpoint
+    # The lambda reads its configuration from the environment when imported.
+    os.environ['DSS_ENDPOINT'] = args.dss_endpoint
+    os.environ.setdefault('DOS_METRICS', 'false')
+    service_url = args.service_url or serve_lambda()
+
+    from chalicelib.sessions import get_session
+    session = get_session()
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            for name, make_request in lambda_scenarios(service_url, catalog):
+                if args.scenario and name not in args.scenario:
+                    continue
+                results.append(load(name, session, make_request, args.requests, concurrency))
+            if not args.scenario or 'remote_to_bag' in args.scenario:
+                results.append(bench_remote_to_bag(service_url, catalog, concurrency))
+    finally:
+        if dss:
+            dss.stop()
+    print_table(results)
+    if dss:
+        print('\nFake DSS requests: {}'.format(json.dumps(dss.requests, sort_keys=True)))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'args': vars(args), 'results': results}, fp, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() is not None else 1)
@@ -0,0 +1,4 @@
+"""
+Supporting modules for dos-dss-lambda. Chalice packages this directory
+alongside `app.py` when deploying.
+"""
@@ -0,0 +1,235 @@
+"""
+In-process caches for DSS responses.
+
+A Lambda container serves many requests over its lifetime, so keeping
+recently fetched bundle manifests around saves us from downloading the same
+bundle for every file in it and again for every replica. The same goes for
+the reference JSON of files by reference, which never changes for a version.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from chalicelib import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DSSCache(object):
+    """
+    A thread safe, size bounded LRU cache of DSS responses, such as bundle
+    manifests, keyed by `(uuid, version, replica)`.
+
+    DSS bundles and files are immutable once a version is given, so only
+    entries cached without a version (i.e. "the latest version") expire after
+    `ttl` seconds.
+
+    If `directory` is given, entries are also written through to disk there so
+    that they survive in /tmp between invocations of a warm container, and are
+    read back on an in-memory miss. Once the entries on disk take up more than
+    `max_disk_bytes`, the least recently used ones, by modification time, are
+    deleted until they take up no more than `disk_low_water` of that.
+
+    With a `stale_ttl`, :meth:`get_or_load` keeps returning an expired entry
+    for up to that many seconds more while it reloads it in the background
+    on `executor`, so that requests don't wait for DSS when the latest
+    version of a hot bundle expires.
+
+    Hits and misses are counted in the request's metrics under `name`.
+    """
+
+    def __init__(self, name='cache', max_size=256, ttl=300, directory=None, clock=time.time,
+                 stale_ttl=0, executor=None, max_disk_bytes=256 * 1024 * 1024, disk_low_water=0.8):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_low_water = disk_low_water
+        self.clock = clock
+        self.stale_ttl = stale_ttl
+        self.executor = executor
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def _expired(self, key, stored_at, grace=0):
+        _, version, _ = key
+        return version is None and self.clock() - stored_at > self.ttl + grace
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None if it isn't cached or has
+        expired.
+        :param key:
+        :return:
+        """
+        entry = self._get(key)
+        metrics.current().record_cache(self.name, entry is not None)
+        return entry[1] if entry is not None else None
+
+    def _get(self, key, grace=0):
+        # Entries are kept until they are too old to be served even stale.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(key, entry[0], self.stale_ttl):
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        if entry is None and self.directory:
+            entry = self._read(key)
+            if entry is not None:
+                if self._expired(key, entry[0], self.stale_ttl):
+                    self._remove(self._path(key))
+                    entry = None
+                else:
+                    self._store(key, entry)
+        if entry is None or self._expired(key, entry[0], grace):
+            return None
+        return entry
+
+    def put(self, key, value):
+        """
+        Caches `value` under `key`, evicting the least recently used entries
+        when the cache is full.
+        :param key:
+        :param value:
+        :return:
+        """
+        entry = (self.clock(), value)
+        self._store(key, entry)
+        if self.directory:
+            self._write(key, entry)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for `key`, calling `loader()` and caching
+        its result on a miss. An entry that expired less than `stale_ttl`
+        seconds ago is returned as is and reloaded in the background.
+        :param key:
+        :param loader:
+        :return:
+        """
+        entry = self._get(key, grace=self.stale_ttl)
+        metrics.current().record_cache(self.name, entry is not None)
+        if entry is not None:
+            if self._expired(key, entry[0]):
+                self._refresh(key, loader)
+            return entry[1]
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def _refresh(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.put(key, loader())
+            except Exception as e:
+                logger.warning('Could not refresh cache entry %s: %s', key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        if self.executor is not None:
+            self.executor.submit(metrics.bound(refresh))
+        else:
+            threading.Thread(target=metrics.bound(refresh)).start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as fp:
+                stored = json.load(fp)
+            # The modification time tells eviction when an entry was last used.
+            os.utime(path, None)
+            return stored['stored_at'], stored['value']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, key, entry):
+        # Write to a temporary file and rename it into place so that a
+        # concurrent reader never sees a partially written entry.
+        path = self._path(key)
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump({'stored_at': entry[0], 'value': entry[1]}, fp)
+            size = os.path.getsize(tmp_path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write cache entry %s: %s', path, e)
+            return
+        with self._disk_lock:
+            self._disk_bytes += size
+            if self.max_disk_bytes is not None and self._disk_bytes > self.max_disk_bytes:
+                self._evict_from_disk()
+
+    def _disk_entries(self):
+        """
+        Returns `(mtime, path, size)` for each entry on disk.
+        """
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict_from_disk(self):
+        # Our running total doesn't know about overwritten entries or those
+        # written by other processes, so the directory is rescanned.
+        entries = sorted(self._disk_entries())
+        self._disk_bytes = sum(size for _, _, size in entries)
+        target = self.max_disk_bytes * self.disk_low_water
+        for _, path, size in entries:
+            if self._disk_bytes <= target:
+                break
+            if self._remove(path):
+                self._disk_bytes -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
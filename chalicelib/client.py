@@ -0,0 +1,103 @@
+"""
+Lazy construction of the DSS client.
+
+Building :class:`~hca.dss.DSSClient` imports a large dependency tree and reads
+the DSS swagger description (downloading it if it isn't cached), so we put
+that off until a request actually needs DSS. Requests for `/` or
+`/swagger.json` never pay for it, nor for importing requests and urllib3 for
+the pooled session of :mod:`chalicelib.sessions`.
+
+To avoid downloading the DSS swagger description on every cold start, vendor
+it into the deployment package with
+
+    DSS_ENDPOINT=... python -m chalicelib.client
+"""
+import base64
+import os
+import threading
+try:
+    import urllib.parse as urlparse  # For Python 3 compat
+except ImportError:
+    import urlparse
+
+from chalicelib import coldstart
+
+# If DSS_ENDPOINT is set, make sure it doesn't have a trailing /
+DSS_ENDPOINT = os.environ.get('DSS_ENDPOINT', 'https://commons-dss.ucsc-cgp-dev.org/v1')
+DSS_SWAGGER_URL = DSS_ENDPOINT + '/swagger.json'
+
+# Vendored DSS swagger descriptions are named after the URL they came from, so
+# that every stage finds the one for its own DSS_ENDPOINT.
+DSS_SWAGGER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dss-swagger')
+DSS_SWAGGER_FILE = os.environ.get('DSS_SWAGGER_FILE', os.path.join(
+    DSS_SWAGGER_DIR, base64.urlsafe_b64encode(DSS_SWAGGER_URL.encode('utf-8')).decode('utf-8') + '.json'))
+
+_dss = None
+_lock = threading.Lock()
+
+
+def make_dss_client():
+    """
+    Builds a new :class:`~hca.dss.DSSClient` for `DSS_ENDPOINT`.
+    :return:
+    """
+    with coldstart.phase('import hca'):
+        import hca.dss
+        from chalicelib import sessions
+    with coldstart.phase('configure hca'):
+        # tweak, which underpins the :class:`~hca.HCAConfig` object, will try to
+        # create a config directory if one does not exist. This is fine if we're
+        # running locally, but not so much if this is deployed on AWS Lambda as
+        # the home directory is read-only. AWS Lambda provides /tmp as a non-persistent
+        # staging area, so we set the `_user_config_home` variable to /tmp so that
+        # dos-dss-lambda doesn't die when we try to instantiate :class:`~hca.dss.DSSClient`.
+        # hca also caches the DSS swagger description there.
+        hca.HCAConfig._user_config_home = '/tmp/'
+        config = hca.HCAConfig(save_on_exit=False, autosave=False)
+        config['DSSClient'].swagger_url = DSS_SWAGGER_URL
+        if os.path.exists(DSS_SWAGGER_FILE):
+            config.swagger_filename = DSS_SWAGGER_FILE
+    with coldstart.phase('build DSS client'):
+        # hca assumes https, which a local stand-in for DSS may not speak.
+        hca.dss.DSSClient.scheme = urlparse.urlparse(DSS_ENDPOINT).scheme or 'https'
+        dss = hca.dss.DSSClient(config=config)
+        # Replace hca's own adapter and timeouts with our pooled, retrying one.
+        sessions.configure_session(dss.get_session())
+        dss.timeout_policy = (sessions.CONNECT_TIMEOUT, sessions.READ_TIMEOUT)
+    coldstart.report()
+    return dss
+
+
+def get_dss():
+    """
+    Returns the DSS client of this container, building it on first use.
+    :return:
+    """
+    global _dss
+    if _dss is None:
+        with _lock:
+            if _dss is None:
+                _dss = make_dss_client()
+    return _dss
+
+
+def vendor_dss_swagger(fname=DSS_SWAGGER_FILE):
+    """
+    Downloads the DSS swagger description for `DSS_ENDPOINT` into the
+    deployment package.
+    :param fname:
+    :return:
+    """
+    from chalicelib import sessions
+    res = sessions.get_session().get(DSS_SWAGGER_URL)
+    res.raise_for_status()
+    assert 'swagger' in res.json()
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    with open(fname, 'wb') as fp:
+        fp.write(res.content)
+    return fname
+
+
+if __name__ == '__main__':
+    print(vendor_dss_swagger())
@@ -0,0 +1,55 @@
+"""
+Cold start timing.
+
+Set `DOS_COLDSTART_TIMING=true` to log how long each phase of bringing up a
+Lambda container takes, e.g. importing modules or building the DSS client.
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+
+ENABLED = os.environ.get('DOS_COLDSTART_TIMING', '').lower() in ('1', 'true', 'yes')
+
+logger = logging.getLogger('dos-dss-lambda.coldstart')
+
+# When this module was first imported, which is as close to the start of the
+# container as we can get.
+STARTED_AT = time.time()
+
+_phases = collections.OrderedDict()
+_reported = set()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Records how long the body of the `with` block takes under `name`.
+    :param name:
+    :return:
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        _phases[name] = _phases.get(name, 0) + (time.time() - start)
+
+
+def report():
+    """
+    Logs the phases recorded since the last report as a single JSON line,
+    along with the time since the container started.
+    :return:
+    """
+    if not ENABLED:
+        return
+    phases = collections.OrderedDict(
+        (name, round(seconds * 1000, 1)) for name, seconds in _phases.items() if name not in _reported)
+    if not phases:
+        return
+    _reported.update(phases)
+    logger.info('Cold start timing: %s', json.dumps({
+        'phases_ms': phases,
+        'since_start_ms': round((time.time() - STARTED_AT) * 1000, 1)}))
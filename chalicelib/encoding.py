@@ -0,0 +1,29 @@
+"""
+Compact JSON encoding of responses and remote-file-manifests.
+
+Large list pages, bundles and manifests are encoded with orjson if it is
+installed, which is several times faster than the json module, and without
+the whitespace json puts between items by default.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # Falls back to the json module
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Encodes `obj` as compact JSON.
+    :param obj:
+    :return: (str)
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson is stricter than json, e.g. about integers that don't
+            # fit in 64 bits or keys that aren't strings.
+            pass
+    return json.dumps(obj, separators=(',', ':'))
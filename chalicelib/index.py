@@ -0,0 +1,222 @@
+"""
+A precomputed index of the files in DSS.
+
+Resolving a Data Object live takes a HEAD of the file, only to learn which
+bundle it is in, and a GET of that bundle from every replica for its URLs.
+The index maps each file to its bundle, size, checksums and replica URLs
+ahead of time, so that resolving it takes a single SQLite query.
+
+The index is built by crawling the DSS search, and refreshed the same way,
+which only fetches the bundles that aren't indexed yet:
+
+    DSS_ENDPOINT=... python -m chalicelib.index s3://bucket/dss-index.sqlite
+
+Point DOS_FILE_INDEX at the index, either on S3 or at a file in the
+deployment package. It is copied to /tmp on first use. Files that aren't in
+the index are resolved live. Files without a version resolve to the latest
+version as of the last refresh.
+"""
+import argparse
+from concurrent import futures
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+try:
+    import urllib.parse as urlparse  # For Python 3 compat
+except ImportError:
+    import urlparse
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS bundles (uuid TEXT, version TEXT, PRIMARY KEY (uuid, version))',
+    'CREATE TABLE IF NOT EXISTS files ('
+    ' uuid TEXT, version TEXT, bundle_uuid TEXT, bundle_version TEXT, position INTEGER,'
+    ' name TEXT, size INTEGER, content_type TEXT,'
+    ' sha256 TEXT, s3_etag TEXT, sha1 TEXT, crc32c TEXT, urls TEXT,'
+    ' PRIMARY KEY (uuid, version, bundle_uuid, bundle_version))',
+    'CREATE INDEX IF NOT EXISTS files_by_bundle ON files (bundle_uuid, bundle_version, position)',
+]
+
+COLUMNS = ['uuid', 'version', 'bundle_uuid', 'bundle_version', 'name', 'size', 'content_type',
+           'sha256', 's3_etag', 'sha1', 'crc32c', 'urls']
+
+
+class FileIndex(object):
+    """
+    Read-only lookups in an index built by :func:`build_index`.
+
+    Files come back shaped like the file entries of a DSS bundle manifest,
+    plus the `bundle_uuid` and `bundle_version` of the bundle they are in and
+    their `urls` by replica.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        uri = 'file:{}?mode=ro&immutable=1'.format(urlparse.quote(os.path.abspath(path)))
+        self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    @staticmethod
+    def _to_file(row):
+        values = dict(zip(COLUMNS, row))
+        dss_file = {key: values[key] for key in ('uuid', 'version', 'bundle_uuid', 'bundle_version', 'name',
+                                                  'size', 'sha256', 's3_etag', 'sha1', 'crc32c')}
+        dss_file['content-type'] = values['content_type']
+        dss_file['urls'] = json.loads(values['urls'])
+        return dss_file
+
+    def get_file(self, uuid, version=None):
+        """
+        Returns the given version of a file, or its latest indexed version,
+        or None if it isn't indexed.
+        :param uuid:
+        :param version:
+        :return:
+        """
+        sql = 'SELECT {} FROM files WHERE uuid = ?'.format(', '.join(COLUMNS))
+        args = [uuid]
+        if version:
+            sql += ' AND version = ?'
+            args.append(version)
+        rows = self._query(sql + ' ORDER BY version DESC, bundle_version DESC LIMIT 1', args)
+        return self._to_file(rows[0]) if rows else None
+
+    def get_bundle_files(self, bundle_uuid, bundle_version):
+        """
+        Returns the files of a bundle in manifest order, or None if the
+        bundle isn't indexed.
+        :param bundle_uuid:
+        :param bundle_version:
+        :return:
+        """
+        if not self._query('SELECT 1 FROM bundles WHERE uuid = ? AND version = ?', [bundle_uuid, bundle_version]):
+            return None
+        rows = self._query('SELECT {} FROM files WHERE bundle_uuid = ? AND bundle_version = ? '
+                           'ORDER BY position'.format(', '.join(COLUMNS)), [bundle_uuid, bundle_version])
+        return [self._to_file(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _split_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def load_index(location):
+    """
+    Opens the index at `location`, a local path or an `s3://` URL, which is
+    downloaded to /tmp unless a warm container already did.
+    :param location:
+    :return: a :class:`FileIndex`
+    """
+    if location.startswith('s3://'):
+        import boto3
+        path = os.path.join(tempfile.gettempdir(),
+                            'dss-index-{}.sqlite'.format(hashlib.sha1(location.encode('utf-8')).hexdigest()))
+        if not os.path.exists(path):
+            bucket, key = _split_s3_url(location)
+            boto3.client('s3').download_file(bucket, key, path + '.part')
+            os.rename(path + '.part', path)
+        location = path
+    return FileIndex(location)
+
+
+def build_index(path, replicas, per_page=500, workers=8, es_query=None):
+    """
+    Crawls the DSS bundle search and adds the files of every bundle that
+    isn't indexed yet to the index at `path`, creating it if needed. Each
+    page of bundles is committed as it is done, so an interrupted crawl picks
+    up where it stopped when run again.
+    :param path:
+    :param replicas: the replicas to index URLs for; the search goes to the
+        first one, and a bundle is only indexed if that one has it
+    :param per_page:
+    :param workers: number of bundles and replicas fetched at once
+    :param es_query:
+    :return: the number of bundles added
+    """
+    from chalicelib.client import get_dss
+    from chalicelib.search import iter_search_results
+    dss = get_dss()
+    db = sqlite3.connect(path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    indexed = set(db.execute('SELECT uuid, version FROM bundles'))
+    added = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for results in iter_search_results(dss, replicas[0], per_page, es_query=es_query):
+            bundles = [tuple(result['bundle_fqid'].split('.', 1)) for result in results]
+            bundles = [bundle for bundle in bundles if bundle not in indexed]
+            pending = {(bundle, replica): executor.submit(dss.get_bundle, uuid=bundle[0], version=bundle[1],
+                                                          replica=replica)
+                       for bundle in bundles for replica in replicas}
+            for bundle in bundles:
+                manifests = {}
+                for replica in replicas:
+                    try:
+                        manifests[replica] = pending[bundle, replica].result()['bundle']
+                    except Exception as e:
+                        logger.warning('Could not fetch bundle %s.%s from replica %s: %s',
+                                       bundle[0], bundle[1], replica, e)
+                if replicas[0] not in manifests:
+                    continue
+                urls = {}
+                for replica, manifest in manifests.items():
+                    for dss_file in manifest['files']:
+                        if dss_file.get('url'):
+                            urls.setdefault(dss_file['uuid'], {})[replica] = dss_file['url']
+                db.executemany('INSERT OR REPLACE INTO files VALUES ({})'.format(', '.join('?' * 13)), [
+                    (dss_file['uuid'], dss_file['version'], bundle[0], bundle[1], position,
+                     dss_file.get('name'), dss_file.get('size'), dss_file.get('content-type'),
+                     dss_file.get('sha256'), dss_file.get('s3_etag'), dss_file.get('sha1'), dss_file.get('crc32c'),
+                     json.dumps(urls.get(dss_file['uuid'], {})))
+                    for position, dss_file in enumerate(manifests[replicas[0]]['files'])])
+                db.execute('INSERT OR REPLACE INTO bundles VALUES (?, ?)', bundle)
+                indexed.add(bundle)
+                added += 1
+            db.commit()
+            logger.info('Indexed %s bundles', len(indexed))
+    db.close()
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='path or s3:// URL of the index to build or refresh')
+    parser.add_argument('--replicas', default=os.environ.get('DSS_REPLICAS', 'aws,azure,gcp'))
+    parser.add_argument('--per-page', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    replicas = [replica.strip() for replica in args.replicas.split(',') if replica.strip()]
+    path = args.output
+    if args.output.startswith('s3://'):
+        import boto3
+        from botocore.exceptions import ClientError
+        s3 = boto3.client('s3')
+        bucket, key = _split_s3_url(args.output)
+        path = os.path.join(tempfile.mkdtemp(), 'dss-index.sqlite')
+        try:
+            s3.download_file(bucket, key, path)
+        except ClientError:
+            logger.info('Building a new index at %s', args.output)
+    added = build_index(path, replicas, per_page=args.per_page, workers=args.workers)
+    if args.output.startswith('s3://'):
+        s3.upload_file(path, bucket, key)
+    print('Added {} bundles to {}'.format(added, args.output))
+
+
+if __name__ == '__main__':
+    main()
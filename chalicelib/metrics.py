@@ -0,0 +1,249 @@
+"""
+Per-request metrics.
+
+Every upstream DSS call made while serving a request is timed and counted,
+along with replica failures and replicas left out, cache hits and misses, the calls that were
+coalesced with an identical one already in flight, and the retries and
+connection pools of the sessions in :mod:`chalicelib.sessions`. At the end of the
+request the metrics are returned to the client as a `Server-Timing` header
+and logged as a CloudWatch Embedded Metric Format (EMF) line.
+
+A Lambda container serves one request at a time, so the metrics of the
+request in progress are kept in a module global. Work handed to other
+threads should be wrapped with :func:`bound` so that it reports to the
+request that started it, even if it finishes late.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+ENABLED = os.environ.get('DOS_METRICS', 'true').lower() in ('1', 'true', 'yes')
+NAMESPACE = os.environ.get('DOS_METRICS_NAMESPACE', 'dos-dss-lambda')
+
+
+def _session_metrics():
+    """
+    Returns the :class:`~chalicelib.sessions.SessionMetrics` of this process,
+    or None if nothing has needed a session yet. Importing requests just to
+    find no retries would slow down cold starts.
+    """
+    sessions = sys.modules.get('chalicelib.sessions', None)
+    return sessions.metrics if sessions is not None else None
+
+
+def _retries():
+    session_metrics = _session_metrics()
+    return collections.Counter(session_metrics.snapshot()['retries'] if session_metrics is not None else {})
+
+
+class RequestMetrics(object):
+    """
+    The metrics collected while serving a single request.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.status_code = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.upstream = collections.OrderedDict()
+        self.upstream_errors = collections.Counter()
+        self.replica_failures = collections.Counter()
+        self.degraded = collections.Counter()
+        self.cache = collections.defaultdict(collections.Counter)
+        self.coalesced = collections.Counter()
+        self.retries = collections.Counter()
+        self.pools = {}
+        self._retries_at_start = _retries()
+        self._lock = threading.Lock()
+
+    def record_call(self, name, seconds, ok=True):
+        with self._lock:
+            self.upstream.setdefault(name, []).append(seconds)
+            if not ok:
+                self.upstream_errors[name] += 1
+
+    def record_replica_failure(self, replica):
+        with self._lock:
+            self.replica_failures[replica] += 1
+
+    def record_degraded(self, replica):
+        """
+        Records that a replica was left out of the response without it
+        failing, e.g. because it was being skipped or there wasn't time left
+        to ask it.
+        """
+        with self._lock:
+            self.degraded[replica] += 1
+
+    def incomplete(self):
+        """
+        Returns the replicas whose URLs may be missing from the response.
+        """
+        with self._lock:
+            return set(self.replica_failures) | set(self.degraded)
+
+    def record_cache(self, name, hit):
+        with self._lock:
+            self.cache[name]['hits' if hit else 'misses'] += 1
+
+    def record_coalesced(self, shared):
+        with self._lock:
+            self.coalesced['shared' if shared else 'issued'] += 1
+
+    def finish(self, status_code=None):
+        """
+        Stops the clock and records the status code of the response, the HTTP
+        retries made since the request began, by method, and the usage of the
+        connection pools.
+        """
+        self.finished_at = time.time()
+        self.status_code = status_code
+        session_metrics = _session_metrics()
+        if session_metrics is not None:
+            snapshot = session_metrics.snapshot()
+            retries = collections.Counter(snapshot['retries'])
+            retries.subtract(self._retries_at_start)
+            with self._lock:
+                self.retries = +retries
+                self.pools = snapshot['pools']
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def server_timing(self):
+        """
+        Returns the value of a `Server-Timing` header with the total time
+        spent in each kind of upstream call and in the whole request.
+        :return:
+        """
+        with self._lock:
+            entries = ['{};dur={:.1f};desc="{} calls"'.format(name, sum(durations) * 1000, len(durations))
+                       for name, durations in self.upstream.items()]
+        entries.append('total;dur={:.1f}'.format(self.duration * 1000))
+        return ', '.join(entries)
+
+    def emf(self):
+        """
+        Returns the metrics as a CloudWatch Embedded Metric Format document,
+        with `Route` as the dimension.
+        :return:
+        """
+        with self._lock:
+            upstream = collections.OrderedDict(
+                (name, [round(d * 1000, 1) for d in durations]) for name, durations in self.upstream.items())
+            values = collections.OrderedDict([
+                ('Latency', round(self.duration * 1000, 1)),
+                ('Errors', 1 if self.status_code is None or self.status_code >= 500 else 0),
+                ('UpstreamCalls', sum(len(durations) for durations in upstream.values())),
+                ('UpstreamErrors', sum(self.upstream_errors.values())),
+                ('ReplicaFailures', sum(self.replica_failures.values())),
+                ('DegradedReplicas', sum(self.degraded.values())),
+                ('CacheHits', sum(counts['hits'] for counts in self.cache.values())),
+                ('CacheMisses', sum(counts['misses'] for counts in self.cache.values())),
+                ('CoalescedCalls', self.coalesced['shared']),
+                ('Retries', sum(self.retries.values())),
+                ('PooledConnections', sum(pool.get('connections', 0) for pool in self.pools.values())),
+            ])
+            units = {'Latency': 'Milliseconds'}
+            for name, durations in upstream.items():
+                values['Upstream.' + name] = durations
+                units['Upstream.' + name] = 'Milliseconds'
+            document = collections.OrderedDict([
+                ('_aws', {
+                    'Timestamp': int(self.started_at * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [['Route']],
+                        'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in values]}]}),
+                ('Route', self.route),
+                ('StatusCode', self.status_code),
+                ('replica_failures', dict(self.replica_failures)),
+                ('degraded_replicas', dict(self.degraded)),
+                ('cache', {name: dict(counts) for name, counts in self.cache.items()}),
+                ('retries', dict(self.retries)),
+                ('pools', self.pools),
+            ])
+        document.update(values)
+        return document
+
+
+_current = None
+_local = threading.local()
+
+
+def begin(route):
+    """
+    Starts collecting metrics for a new request.
+    :param route:
+    :return:
+    """
+    global _current
+    _current = RequestMetrics(route)
+    return _current
+
+
+def current():
+    """
+    Returns the metrics of the request the calling thread is working for.
+    Outside of a request, the metrics are collected but go nowhere.
+    :return:
+    """
+    request_metrics = getattr(_local, 'metrics', None) or _current
+    if request_metrics is None:
+        request_metrics = RequestMetrics(None)
+    return request_metrics
+
+
+def bound(fn):
+    """
+    Wraps `fn` so that, whichever thread it runs on, it reports to the
+    metrics of the request in progress now.
+    :param fn:
+    :return:
+    """
+    request_metrics = current()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'metrics', None)
+        _local.metrics = request_metrics
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.metrics = previous
+    return wrapper
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Records how long the body of the `with` block takes as an upstream call
+    named `name`, and whether it raised.
+    :param name:
+    :return:
+    """
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        current().record_call(name, time.time() - start, ok)
+
+
+def emit(request_metrics):
+    """
+    Logs the metrics of a request as an EMF line on stdout, where CloudWatch
+    picks them up.
+    :param request_metrics:
+    :return:
+    """
+    if ENABLED:
+        print(json.dumps(request_metrics.emf()))
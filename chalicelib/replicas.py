@@ -0,0 +1,144 @@
+"""
+Health and latency of the DSS replicas.
+
+Every upstream call made against a replica is reported to a
+:class:`ReplicaTracker`, which keeps a moving average of the response times
+and error rate of each replica. Replicas are ordered by the time they are
+expected to take to answer successfully, so that URLs of the fastest replica
+come first and lookups go to it first.
+
+A replica that keeps failing, or answering slower than it may, is skipped
+for a while by a circuit breaker. Once that time is up a single call is let
+through to find out whether it recovered.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class ReplicaStats(object):
+    """
+    The moving averages and circuit breaker state of a single replica.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def as_dict(self):
+        return {'latency': self.latency, 'error_rate': self.error_rate, 'state': self.state}
+
+
+class ReplicaTracker(object):
+    """
+    A thread safe tracker of the latency and errors of `replicas`.
+
+    Calls that raise, or take longer than `slow` seconds, count as failures.
+    After `failure_threshold` consecutive failures a replica's circuit opens
+    and it is skipped for `cooldown` seconds.
+    """
+
+    def __init__(self, replicas, alpha=0.2, failure_threshold=5, cooldown=30, slow=None,
+                 clock=time.time):
+        self.replicas = list(replicas)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow = slow
+        self.clock = clock
+        self._stats = {replica: ReplicaStats() for replica in self.replicas}
+        self._lock = threading.Lock()
+
+    def record(self, replica, seconds, ok=True):
+        """
+        Records a call to `replica` that took `seconds` and succeeded or not.
+        :param replica:
+        :param seconds:
+        :param ok:
+        :return:
+        """
+        if self.slow is not None and seconds > self.slow:
+            ok = False
+        with self._lock:
+            stats = self._stats.get(replica)
+            if stats is None:
+                return
+            if stats.latency is None:
+                stats.latency = seconds
+            else:
+                stats.latency += self.alpha * (seconds - stats.latency)
+            stats.error_rate += self.alpha * ((0.0 if ok else 1.0) - stats.error_rate)
+            stats.trial_started_at = None
+            if ok:
+                if stats.state != CLOSED:
+                    logger.info('Replica %s recovered', replica)
+                stats.consecutive_failures = 0
+                stats.state = CLOSED
+            else:
+                stats.consecutive_failures += 1
+                if stats.state == HALF_OPEN or stats.consecutive_failures >= self.failure_threshold:
+                    if stats.state != OPEN:
+                        logger.warning('Skipping replica %s for %ss after %s failures',
+                                       replica, self.cooldown, stats.consecutive_failures)
+                    stats.state = OPEN
+                    stats.opened_at = self.clock()
+
+    def _available(self, stats):
+        now = self.clock()
+        if stats.state == OPEN and now - stats.opened_at >= self.cooldown:
+            stats.state = HALF_OPEN
+        if stats.state == HALF_OPEN:
+            # A trial call that never reported back doesn't block the replica
+            # for good.
+            return stats.trial_started_at is None or now - stats.trial_started_at >= self.cooldown
+        return stats.state == CLOSED
+
+    def _expected_seconds(self, stats):
+        # The time a successful answer is expected to take, counting retries
+        # of failed calls. Replicas we know nothing about yet stay in their
+        # configured order after those we do.
+        if stats.latency is None:
+            return float('inf')
+        return stats.latency / max(1.0 - stats.error_rate, 0.1)
+
+    def ordered(self):
+        """
+        Returns all replicas, fastest first, with those that are skipped last.
+        :return:
+        """
+        with self._lock:
+            available = [r for r in self.replicas if self._available(self._stats[r])]
+            skipped = [r for r in self.replicas if r not in available]
+            available.sort(key=lambda r: self._expected_seconds(self._stats[r]))
+        return available + skipped
+
+    def available(self):
+        """
+        Returns the replicas that may be called, fastest first. A replica
+        whose circuit is half open is included once, for a trial call. If
+        every replica is being skipped, all of them are returned rather than
+        none.
+        :return:
+        """
+        with self._lock:
+            available = [r for r in self.replicas if self._available(self._stats[r])]
+            if not available:
+                available = list(self.replicas)
+            available.sort(key=lambda r: self._expected_seconds(self._stats[r]))
+            for replica in available:
+                stats = self._stats[replica]
+                if stats.state == HALF_OPEN:
+                    stats.trial_started_at = self.clock()
+        return available
+
+    def snapshot(self):
+        with self._lock:
+            return {replica: stats.as_dict() for replica, stats in self._stats.items()}
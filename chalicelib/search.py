@@ -0,0 +1,66 @@
+"""
+Paging through the DSS bundle search.
+
+DSS pages its search results the GitHub way: the `Link` header of a page
+points at the next one, with a `search_after` token in its query string.
+The DSS client doesn't expose response headers, so we go through
+`DSSClient().post_search._request`, which returns the underlying
+:class:`~requests.Response`. It is undocumented; the source code is here:
+https://github.com/HumanCellAtlas/dcp-cli/blob/aa811490d3c680018f6c1abeef3292098556b0ea/hca/util/__init__.py#L119
+"""
+try:
+    import urllib.parse as urlparse  # For Python 3 compat
+except ImportError:
+    import urlparse
+
+# The number of results DSS returns per page must be in this range, and
+# raw results, which carry the metadata of their bundle, are limited to
+# MAX_RAW_PER_PAGE.
+MIN_PER_PAGE = 10
+MAX_PER_PAGE = 500
+MAX_RAW_PER_PAGE = 10
+
+
+def search(dss, replica, per_page, search_after=None, es_query=None, output_format=None):
+    """
+    Requests one page of bundle search results from DSS and returns the
+    results along with the `search_after` token of the next page, or None if
+    this is the last page. With `output_format='raw'` each hit also carries
+    the indexed metadata of its bundle, including the bundle manifest.
+    :param dss: a :class:`~hca.dss.DSSClient`
+    :param replica:
+    :param per_page:
+    :param search_after:
+    :param es_query:
+    :param output_format:
+    :return:
+    """
+    req_args = dict(replica=replica, per_page=per_page, es_query=es_query if es_query is not None else {})
+    if search_after:
+        req_args['search_after'] = search_after
+    if output_format:
+        req_args['output_format'] = output_format
+    res = dss.post_search._request(req_args)
+    next_search_after = None
+    if res.links.get('next', None):
+        # The first search_after item of the query string in the link
+        next_search_after = urlparse.parse_qs(urlparse.urlparse(res.links['next']['url']).query)['search_after'][0]
+    return res.json()['results'], next_search_after
+
+
+def iter_search_results(dss, replica, per_page, search_after=None, es_query=None):
+    """
+    Yields the results of each page of the DSS bundle search, starting at
+    `search_after`.
+    :param dss: a :class:`~hca.dss.DSSClient`
+    :param replica:
+    :param per_page:
+    :param search_after:
+    :param es_query:
+    :return:
+    """
+    while True:
+        results, search_after = search(dss, replica, per_page, search_after, es_query)
+        yield results
+        if not search_after:
+            return
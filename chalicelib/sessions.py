@@ -0,0 +1,163 @@
+"""
+Pooled, keep-alive HTTP sessions shared by everything that talks to DSS or
+to the DOS lambda.
+
+Every session configured here reuses connections per host, applies default
+connect/read timeouts and retries idempotent requests (HEAD/GET) with
+exponential backoff and full jitter. Retries and connection pool usage are
+counted in :data:`metrics`.
+"""
+import collections
+import logging
+import os
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import retry
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = float(os.environ.get('DOS_HTTP_CONNECT_TIMEOUT', '5'))
+# DSS answers within its API Gateway timeout of 30 seconds, so the read
+# timeout is a little longer than that to consistently get DSS' 504 instead.
+READ_TIMEOUT = float(os.environ.get('DOS_HTTP_READ_TIMEOUT', '40'))
+# The number of hosts we keep pools for and the connections kept per host.
+POOL_HOSTS = int(os.environ.get('DOS_HTTP_POOL_HOSTS', '10'))
+POOL_SIZE = int(os.environ.get('DOS_HTTP_POOL_SIZE', '16'))
+RETRIES = int(os.environ.get('DOS_HTTP_RETRIES', '5'))
+BACKOFF_FACTOR = float(os.environ.get('DOS_HTTP_BACKOFF_FACTOR', '0.25'))
+
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET'])
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+class SessionMetrics(object):
+    """
+    Thread safe counters of the retries made by the sessions configured here,
+    along with the connection pools of those sessions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._adapters = []
+        self.retries = collections.Counter()
+
+    def record_retry(self, method, url, reason):
+        with self._lock:
+            self.retries[method] += 1
+        logger.info('Retrying %s %s after %s', method, url, reason)
+
+    def register(self, adapter):
+        with self._lock:
+            self._adapters.append(adapter)
+
+    def pool_usage(self):
+        """
+        Returns a dictionary mapping each host we hold a connection pool for
+        to the number of connections opened, requests made and connections
+        currently idle in that pool.
+        :return:
+        """
+        usage = {}
+        with self._lock:
+            adapters = list(self._adapters)
+        for adapter in adapters:
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                stats = usage.setdefault(pool.host, collections.Counter())
+                stats['connections'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+                # Empty slots of the pool queue hold None.
+                stats['idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+        return {host: dict(stats) for host, stats in usage.items()}
+
+    def snapshot(self):
+        with self._lock:
+            retries = dict(self.retries)
+        return {'retries': retries, 'pools': self.pool_usage()}
+
+
+metrics = SessionMetrics()
+
+
+class JitteredRetry(retry.Retry):
+    """
+    A retry policy that waits a random time between zero and the usual
+    exponential backoff ("full jitter"), so that many clients failing at the
+    same moment don't all come back at the same moment, and that counts every
+    retry in :data:`metrics`.
+    """
+    # DSS answers 301 with a Retry-After header while it prepares a file or
+    # bundle for download.
+    RETRY_AFTER_STATUS_CODES = frozenset([301]) | retry.Retry.RETRY_AFTER_STATUS_CODES
+
+    def get_backoff_time(self):
+        return random.uniform(0, super(JitteredRetry, self).get_backoff_time())
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        new_retry = super(JitteredRetry, self).increment(method, url, response, error, *args, **kwargs)
+        # Only count the retry once urllib3 decided to make it; it raises
+        # instead when the retries are exhausted or the error isn't retryable.
+        metrics.record_retry(method, url, error or (response.status if response is not None else None))
+        return new_retry
+
+
+def make_retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    kwargs = dict(total=total, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+    try:
+        return JitteredRetry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return JitteredRetry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    An :class:`~requests.adapters.HTTPAdapter` that applies default timeouts
+    to requests made without one.
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, timeout=timeout, **kwargs)
+
+
+def configure_session(session):
+    """
+    Mounts a pooling, retrying adapter with default timeouts on `session`.
+    :param session:
+    :return: the same session
+    """
+    adapter = TimeoutHTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE,
+                                 max_retries=make_retry())
+    metrics.register(adapter)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the session shared by this process, creating it on first use.
+    :return:
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = configure_session(requests.Session())
+    return _session
@@ -0,0 +1,53 @@
+"""
+Coalescing of concurrent identical upstream calls.
+
+When many requests, or many threads of one request, want the same bundle or
+file at the same time, only the first of them asks DSS. The others wait for
+that call and share its result, or its error.
+"""
+from concurrent import futures
+import threading
+
+from chalicelib import metrics
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Calls made for a key while one
+    is in flight wait for it instead of running themselves.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Returns the result of `fn()`, or of the call for `key` that is
+        already in flight.
+        :param key: a hashable key identifying the call
+        :param fn:
+        :return:
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = futures.Future()
+        metrics.current().record_coalesced(not leader)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,56 @@
+"""
+The Data Object Service swagger description served by dos-dss-lambda.
+
+The DOS schema is vendored as `data_object_service.swagger.yaml`. Parsing YAML
+is slow, so the spec is compiled to `swagger.json` ahead of deployment with
+
+    python -m chalicelib.swagger
+
+and the lambda only has to load that JSON once per container.
+"""
+import json
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SWAGGER_YAML = os.path.join(HERE, 'data_object_service.swagger.yaml')
+SWAGGER_JSON = os.path.join(HERE, 'swagger.json')
+
+# Chalice serves the API from the `api` stage of API Gateway.
+BASE_PATH = '/api/ga4gh/dos/v1'
+
+
+def compile_swagger(yaml_fname=SWAGGER_YAML, json_fname=SWAGGER_JSON):
+    """
+    Converts the vendored YAML schema into the JSON document we serve.
+    :param yaml_fname:
+    :param json_fname:
+    :return:
+    """
+    import yaml
+    with open(yaml_fname) as fp:
+        swagger_dict = yaml.safe_load(fp)
+    swagger_dict['basePath'] = BASE_PATH
+    with open(json_fname, 'w') as fp:
+        json.dump(swagger_dict, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+    return swagger_dict
+
+
+def load_swagger():
+    """
+    Returns the swagger description as a dictionary, preferring the
+    precompiled JSON and falling back to parsing the YAML.
+    :return:
+    """
+    if os.path.exists(SWAGGER_JSON):
+        with open(SWAGGER_JSON) as fp:
+            return json.load(fp)
+    import yaml
+    with open(SWAGGER_YAML) as fp:
+        swagger_dict = yaml.safe_load(fp)
+    swagger_dict['basePath'] = BASE_PATH
+    return swagger_dict
+
+
+if __name__ == '__main__':
+    compile_swagger()
@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
 
 from bdbag import bdbag_api
+import collections
+from concurrent import futures
+import hashlib
 import json
 import os
 import shutil
-import requests
+import sqlite3
 import tempfile
+import threading
+import time
 from pprint import pprint
+from urllib.parse import parse_qs, urljoin, urlparse
+
+from chalicelib.encoding import dumps
+from chalicelib.sessions import get_session
+
+try:
+    import crc32c
+except ImportError:  # crc32c checksums are only verified if it is installed
+    crc32c = None
+
+# The size of the chunks payload files are downloaded and hashed in.
+FETCH_CHUNK_SIZE = 1024 * 1024
 
 """Create a BDBag using a remote-file-manifest (RFM)
 (see https://github.com/fair-research/bdbag/blob/master/doc/config.md). 
@@ -22,60 +39,862 @@ The remote-manifest-file is then used as a configuration file to create a BDBag.
 """
 
 
-def make_bag(data_bundles, service_url, base_url):
+def make_bag(data_bundles, service_url, base_url, workers=8,
+             json_lines=True, checkpoint=None, fetch=False,
+             use_manifest=False, dedupe_sha256=False):
     """
-    Takes a list of remote-file-manifest compliant dictionaries, writes
-    them to a temporary file, and creates a BDBag from it.
+    Resolves the data objects of the data bundles into remote-file-manifest
+    compliant dictionaries, streams them to a temporary file as they are
+    resolved, and creates a BDBag from it.
     The inputs to the bdbag_api method is a bit confusing.
      :param data_bundles: list of data bundle dictionaries
      :param service_url: URL to AWS lambda
      :param base_url: URL to GA4GH 
-     :return: none, but it writes a BDBag into `bag_path`.
+     :param workers: (int) number of concurrent requests
+     :param json_lines: (bool) write the manifest as a JSON stream, one
+        entry per line, which bdbag can read without loading it whole
+     :param checkpoint: (str) path of a checkpoint file. Resolved entries
+        are recorded there as they complete, and a rerun with the same path
+        skips them, e.g. after a transient DSS error.
+     :param fetch: (bool) also download the payload files into the bag,
+        see `fetch_payload`. Files that can't be downloaded over HTTP,
+        like files by reference, are skipped and stay in fetch.txt.
+     :param use_manifest: (bool) get the entries of each bundle from the
+        service's bundle manifest endpoint in one request, instead of
+        resolving every data object, see `iter_manifest_entries`
+     :param dedupe_sha256: (bool) also write a single entry for data objects
+        with the same sha256, see `iter_rfm_entries`
+     :return: (list) of RFMFailure of the files `fetch` skipped, but it
+        writes a BDBag into `bag_path`.
     """
-    L = create_list_of_dicts_for_rfm(data_bundles, service_url, base_url)
-
     bag_path = os.path.join(os.getcwd(), 'bag_path')
     old_path = os.getcwd()
+    # The checkpoint outlives the temporary directory we work in below.
+    if checkpoint:
+        checkpoint = os.path.abspath(checkpoint)
 
     # Create temporary directory so we don't need to worry about filename
     # concurrency problems.
     tmp_dir = tempfile.mkdtemp()
     os.chdir(tmp_dir)
-
-    # Write list of dictionaries as JSON file to temporary directory.
-    rfm_fname = os.path.join(os.getcwd(), 'remote-file-manifest.json')
-    with open(rfm_fname, 'w') as fp:
-        json.dump(L, fp)
-    bdbag_api.ensure_bag_path_exists(bag_path)
-    # NOTE: etag or crc32c hashed checksums are not supported by this package.
-    bdbag_api.make_bag(bag_path,
-                       algs=['sha1', 'sha256', 'sha512'],
-                       remote_file_manifest=rfm_fname)
-    os.chdir(old_path)
-    shutil.rmtree(tmp_dir)
-
-
-def create_list_of_dicts_for_rfm(data_bundles, service_url, base_url):
+    try:
+        # Write the dictionaries to a JSON file in the temporary directory.
+        rfm_fname = os.path.join(os.getcwd(), 'remote-file-manifest.json')
+        failures = []
+        skipped = []
+        store = RFMCheckpoint(checkpoint) if checkpoint else None
+        try:
+            iter_entries = iter_manifest_entries if use_manifest \
+                else iter_rfm_entries
+            with open(rfm_fname, 'w') as fp:
+                write_rfm(iter_entries(data_bundles, service_url,
+                                       base_url, workers=workers,
+                                       failures=failures,
+                                       checkpoint=store,
+                                       dedupe_sha256=dedupe_sha256),
+                          fp, json_lines=json_lines)
+        finally:
+            if store:
+                store.close()
+        if failures:
+            raise RFMBuildError(None, failures)
+        bdbag_api.ensure_bag_path_exists(bag_path)
+        # NOTE: etag or crc32c hashed checksums are not supported by this
+        # package.
+        bdbag_api.make_bag(bag_path,
+                           algs=['sha1', 'sha256', 'sha512'],
+                           remote_file_manifest=rfm_fname)
+        if fetch:
+            with open(rfm_fname) as fp:
+                entries = (json.loads(line) for line in fp) \
+                    if json_lines else json.load(fp)
+                fetch_payload(entries, os.path.join(bag_path, 'data'),
+                              service_url, base_url, workers=workers,
+                              failures=failures, skipped=skipped)
+            if failures:
+                raise FetchError(failures)
+    finally:
+        os.chdir(old_path)
+        shutil.rmtree(tmp_dir)
+    return skipped
+
+
+def write_rfm(entries, fp, json_lines=False):
+    """Writes remote-file-manifest entries to `fp` one at a time, so that
+    `entries` can be a generator and the manifest never has to be held in
+    memory.
+    :param entries: (iterable) of RFM dictionaries
+    :param fp: file object to write to
+    :param json_lines: (bool) write one entry per line instead of a JSON
+        array
+    :return: (int) number of entries written"""
+    n_entries = 0
+    if not json_lines:
+        fp.write('[')
+    for entry in entries:
+        if n_entries and not json_lines:
+            fp.write(',\n')
+        fp.write(dumps(entry))
+        if json_lines:
+            fp.write('\n')
+        n_entries += 1
+    if not json_lines:
+        fp.write(']\n')
+    return n_entries
+
+
+def create_list_of_dicts_for_rfm(data_bundles, service_url, base_url,
+                                 workers=8, progress=None,
+                                 dedupe_sha256=False, membership=None):
     """Returns a list of dictionaries, which are compliant with the 
     remote-file-manifest format.
     :param data_bundles: 
     :param service_url: 
     :param base_url: 
+    :param workers: (int) number of concurrent requests
+    :param progress: (callable) called with (done, total) as data objects
+        are resolved
+    :param dedupe_sha256: (bool) see `iter_rfm_entries`
+    :param membership: (dict) see `iter_rfm_entries`
     :return data_object_ids: (list) of RFM dictionaries
-    """
-    data_object_ids = []  # list of data object IDs
-    for bundle_id in data_bundles:
-        bundle = DSSBundle(service_url, base_url, bundle_id['id'])
-        data_object_ids.extend(bundle.get_data_object_list())
+    :raises RFMBuildError: if any bundle or data object could not be
+        resolved, after all others were"""
+    L, failures = build_rfm(data_bundles, service_url, base_url,
+                            workers=workers, progress=progress,
+                            dedupe_sha256=dedupe_sha256,
+                            membership=membership)
+    if failures:
+        raise RFMBuildError(L, failures)
+    return L
 
-    L = []  # to sample list of dictionaries
-    fname_id = 0
-    for data_object_id in data_object_ids:
-        data_object = DSSDataObject(base_url, service_url, data_object_id)
-        L.append(create_dict_for_rfm(data_object, fname_id))
-        fname_id += 1
 
-    return L
+RFMFailure = collections.namedtuple('RFMFailure', ['id', 'error'])
+
+
+class RFMBuildError(Exception):
+    """Raised when some entries of a remote-file-manifest could not be
+    built. Holds the entries that could be built, unless they were streamed
+    elsewhere, and the failures."""
+
+    def __init__(self, entries, failures):
+        super(RFMBuildError, self).__init__(
+            '{} bundles or data objects could not be resolved: {}'.format(
+                len(failures), ', '.join(f.id for f in failures[:10])))
+        self.entries = entries
+        self.failures = failures
+
+
+def build_rfm(data_bundles, service_url, base_url, workers=8,
+              batch_size=100, progress=None, dedupe_sha256=False,
+              membership=None):
+    """Builds a remote-file-manifest in memory, see `iter_rfm_entries`.
+    :param data_bundles: (list) of data bundle dictionaries
+    :param service_url:
+    :param base_url:
+    :param workers: (int) number of concurrent requests
+    :param batch_size: (int) number of data objects requested at once
+    :param progress: (callable) called with (done, total) as data objects
+        are resolved
+    :param dedupe_sha256: (bool) see `iter_rfm_entries`
+    :param membership: (dict) see `iter_rfm_entries`
+    :return: (tuple) of the list of RFM dictionaries and a list of
+        RFMFailure"""
+    failures = []
+    L = list(iter_rfm_entries(data_bundles, service_url, base_url,
+                              workers=workers, batch_size=batch_size,
+                              progress=progress, failures=failures,
+                              dedupe_sha256=dedupe_sha256,
+                              membership=membership))
+    return L, failures
+
+
+def iter_rfm_entries(data_bundles, service_url, base_url, workers=8,
+                     batch_size=100, progress=None, failures=None,
+                     checkpoint=None, dedupe=True, dedupe_sha256=False,
+                     membership=None):
+    """Lazily turns data bundles into remote-file-manifest entries. Bundles
+    are resolved into data object IDs, the IDs into data objects in batches,
+    and the data objects into RFM entries (which may need a HEAD request for
+    the size), each step using up to `workers` concurrent requests and only
+    running a bounded number of steps ahead of the consumer. Memory use stays
+    flat no matter how many data objects there are.
+
+    Entries keep the `dss_data_object_N` file name of their position among
+    all data object IDs, and come out in that order. Failures don't stop the
+    pipeline; they are appended to `failures` instead.
+
+    A data object that is in several bundles is only resolved and written
+    once, at its first position. With `dedupe_sha256`, data objects with the
+    same sha256 as an earlier one are left out after they were resolved too.
+    Either way the IDs seen so far are held in memory.
+    :param data_bundles: (iterable) of data bundle dictionaries
+    :param service_url:
+    :param base_url:
+    :param workers: (int) number of concurrent requests
+    :param batch_size: (int) number of data objects requested at once
+    :param progress: (callable) called with (done, total) as data objects
+        are resolved, where total counts the data objects found so far
+    :param failures: (list) that RFMFailure are appended to
+    :param checkpoint: (RFMCheckpoint) that resolved bundles and entries are
+        recorded in, and that is consulted before resolving them again
+    :param dedupe: (bool) resolve each data object ID only once
+    :param dedupe_sha256: (bool) also write a single entry for data objects
+        with the same sha256
+    :param membership: (dict) that maps the ID of each data bundle to the
+        file names of the entries of its data objects once all entries were
+        generated, in the order of the bundle
+    :return: generator of RFM dictionaries"""
+    if failures is None:
+        failures = []
+    found = [0]
+    bundles = {} if membership is not None else None
+    filenames = {}
+    by_sha256 = {}
+
+    def resolve_batch(batch):
+        # Entries found in the checkpoint take the place of data objects.
+        resolved = checkpoint.get_entries(batch) if checkpoint else {}
+        missing = [i for i in batch if i not in resolved]
+        if missing:
+            data_objects = get_data_object_batch(base_url, service_url,
+                                                 missing)
+            resolved.update(zip(missing, data_objects))
+        return [resolved[i] for i in batch]
+
+    def iter_data_objects(batches):
+        for batch, future in batches:
+            try:
+                data_objects = future.result()
+            except Exception as e:
+                data_objects = [e] * len(batch)
+            for data_object_id, data_object in zip(batch, data_objects):
+                yield found[0], data_object_id, data_object
+                found[0] += 1
+
+    def make_entry(item):
+        fname_id, _, data_object = item
+        if isinstance(data_object, Exception):
+            raise data_object
+        if isinstance(data_object, dict):  # from the checkpoint
+            return dict(data_object,
+                        filename='dss_data_object_' + str(fname_id))
+        return create_dict_for_rfm(data_object, fname_id)
+
+    if dedupe:
+        data_bundles = _unique(data_bundles, key=lambda bundle: bundle['id'])
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        data_object_ids = iter_data_object_ids(data_bundles, service_url,
+                                               base_url, executor, workers,
+                                               failures, checkpoint, bundles)
+        if dedupe:
+            data_object_ids = _unique(data_object_ids)
+        batches = _imap_bounded(executor, resolve_batch,
+                                _chunks(data_object_ids, batch_size), workers)
+        entries = _imap_bounded(executor, make_entry,
+                                iter_data_objects(batches), workers * 4)
+        for done, ((_, data_object_id, data_object), entry) in \
+                enumerate(entries, 1):
+            try:
+                d = entry.result()
+            except Exception as e:
+                failures.append(RFMFailure(data_object_id, e))
+            else:
+                if checkpoint and not isinstance(data_object, dict):
+                    checkpoint.add_entry(data_object_id, d)
+                filename = d['filename']
+                if dedupe_sha256 and d.get('sha256'):
+                    filename = by_sha256.setdefault(d['sha256'], filename)
+                if membership is not None:
+                    filenames[data_object_id] = filename
+                if filename == d['filename']:
+                    yield d
+            if progress:
+                progress(done, found[0])
+    if membership is not None:
+        for bundle_id, data_object_ids in bundles.items():
+            membership[bundle_id] = [filenames[i] for i in data_object_ids
+                                     if i in filenames]
+
+
+def iter_manifest_entries(data_bundles, service_url, base_url, workers=8,
+                          progress=None, failures=None, checkpoint=None,
+                          dedupe=True, dedupe_sha256=False, membership=None):
+    """Like `iter_rfm_entries`, but gets the entries of each data bundle from
+    the manifest endpoint of the service, which resolves the data objects
+    next to DSS, with one request per page of a bundle. Up to `workers`
+    bundles are fetched at once.
+
+    Entries are renamed `dss_data_object_N` by their position among all
+    entries, and point at the files in DSS rather than at the data objects.
+    A file that is in several bundles is only written once, whichever
+    replica its URLs point at.
+    :param data_bundles: (iterable) of data bundle dictionaries
+    :param service_url:
+    :param base_url:
+    :param workers: (int) number of concurrent requests
+    :param progress: (callable) called with (done, total) as bundles are
+        resolved, counting entries
+    :param failures: (list) that RFMFailure are appended to
+    :param checkpoint: (RFMCheckpoint) that the entries of resolved bundles
+        are recorded in, and that is consulted before resolving them again
+    :param dedupe: (bool) write each file only once
+    :param dedupe_sha256: (bool) also write a single entry for files with the
+        same sha256
+    :param membership: (dict) that maps the ID of each data bundle to the
+        file names of the entries of its files
+    :return: generator of RFM dictionaries"""
+    if failures is None:
+        failures = []
+    filenames = {}
+    if dedupe:
+        data_bundles = _unique(data_bundles, key=lambda bundle: bundle['id'])
+
+    def resolve_bundle(bundle):
+        entries = checkpoint.get_manifest(bundle['id']) if checkpoint else None
+        if entries is not None:
+            return entries, True
+        return list(iter_bundle_manifest(service_url, base_url,
+                                         bundle['id'])), False
+
+    n_entries = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for bundle, future in _imap_bounded(executor, resolve_bundle,
+                                            data_bundles, workers):
+            try:
+                entries, checkpointed = future.result()
+            except Exception as e:
+                failures.append(RFMFailure(bundle['id'], e))
+                continue
+            if checkpoint and not checkpointed:
+                checkpoint.add_manifest(bundle['id'], entries)
+            bundle_filenames = []
+            for entry in entries:
+                keys = [_file_key(entry['url'])] if dedupe else []
+                if dedupe_sha256 and entry.get('sha256'):
+                    keys.append(('sha256', entry['sha256']))
+                filename = next((filenames[key] for key in keys
+                                 if key in filenames), None)
+                if filename is None:
+                    filename = 'dss_data_object_' + str(n_entries)
+                    yield dict(entry, filename=filename)
+                    n_entries += 1
+                for key in keys:
+                    filenames.setdefault(key, filename)
+                bundle_filenames.append(filename)
+            if membership is not None:
+                membership[bundle['id']] = bundle_filenames
+            if progress:
+                progress(n_entries, n_entries)
+
+
+def _unique(iterable, key=None):
+    """Yields the items of `iterable` that weren't yielded before, by
+    `key`."""
+    seen = set()
+    for item in iterable:
+        k = item if key is None else key(item)
+        if k not in seen:
+            seen.add(k)
+            yield item
+
+
+def _file_key(url):
+    """Returns what identifies the file at `url` across replicas, i.e. the
+    URL without its `replica` parameter."""
+    url = urlparse(url)
+    query = sorted((key, value)
+                   for key, values in parse_qs(url.query).items()
+                   for value in values if key != 'replica')
+    return url.scheme, url.netloc, url.path, tuple(query)
+
+
+def iter_bundle_manifest(service_url, base_url, data_bundle_id,
+                         page_size=None):
+    """Yields the remote-file-manifest entries of a data bundle from the
+    manifest endpoint of the service, following its pages.
+    :param service_url:
+    :param base_url:
+    :param data_bundle_id:
+    :param page_size: (int) number of entries requested per page
+    :return: generator of RFM dictionaries"""
+    url = os.path.join(service_url, base_url, 'databundles', data_bundle_id,
+                       'manifest')
+    params = {'page_size': page_size} if page_size else None
+    while url:
+        r = get_session().get(url, params=params)
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line.decode('utf-8'))
+        next_page = r.links.get('next')
+        url = urljoin(r.url, next_page['url']) if next_page else None
+        params = None
+
+
+def iter_data_object_ids(data_bundles, service_url, base_url, executor,
+                         window, failures, checkpoint=None, bundles=None):
+    """Lazily yields the data object IDs of each data bundle, resolving up to
+    `window` bundles ahead on `executor`. Bundles that could not be resolved
+    are appended to `failures`. Bundles found in `checkpoint` are not
+    resolved again, and newly resolved ones are recorded there. The data
+    object IDs of each bundle are also recorded in the `bundles` dict, by
+    bundle ID, if one is given."""
+    def resolve_bundle(bundle):
+        data_object_ids = checkpoint.get_bundle(bundle['id']) \
+            if checkpoint else None
+        if data_object_ids is not None:
+            return data_object_ids, True
+        return DSSBundle(service_url, base_url,
+                         bundle['id']).get_data_object_list(), False
+
+    for bundle, future in _imap_bounded(executor, resolve_bundle,
+                                        data_bundles, window):
+        try:
+            data_object_ids, checkpointed = future.result()
+        except Exception as e:
+            failures.append(RFMFailure(bundle['id'], e))
+            continue
+        if checkpoint and not checkpointed:
+            checkpoint.add_bundle(bundle['id'], data_object_ids)
+        if bundles is not None:
+            bundles[bundle['id']] = data_object_ids
+        for data_object_id in data_object_ids:
+            yield data_object_id
+
+
+class RFMCheckpoint:
+    """A SQLite journal of the bundles and remote-file-manifest entries that
+    were resolved while building a bag, keyed by their IDs, so that a failed
+    build can be resumed without resolving them again.
+
+    Writes are committed every `commit_every` records and on `close`."""
+
+    def __init__(self, fname, commit_every=100):
+        self.fname = fname
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS bundles '
+                         '(id TEXT PRIMARY KEY, data_object_ids TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(id TEXT PRIMARY KEY, entry TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS manifests '
+                         '(id TEXT PRIMARY KEY, entries TEXT)')
+        self._db.commit()
+
+    def get_bundle(self, bundle_id):
+        """
+        :return: (list) of the data object IDs of a bundle, or None if the
+            bundle isn't checkpointed"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data_object_ids FROM bundles WHERE id = ?',
+                (bundle_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_bundle(self, bundle_id, data_object_ids):
+        self._add('bundles', bundle_id, data_object_ids)
+
+    def get_entries(self, data_object_ids):
+        """
+        :return: (dict) mapping those of `data_object_ids` that are
+            checkpointed to their RFM dictionaries"""
+        data_object_ids = list(data_object_ids)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, entry FROM entries WHERE id IN ({})'.format(
+                    ', '.join('?' * len(data_object_ids))),
+                data_object_ids).fetchall()
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def add_entry(self, data_object_id, entry):
+        self._add('entries', data_object_id, entry)
+
+    def get_manifest(self, bundle_id):
+        """
+        :return: (list) of the RFM dictionaries of a bundle from its manifest,
+            or None if the bundle isn't checkpointed"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT entries FROM manifests WHERE id = ?',
+                (bundle_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_manifest(self, bundle_id, entries):
+        self._add('manifests', bundle_id, entries)
+
+    def _add(self, table, key, value):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(table),
+                (key, dumps(value)))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._db.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def _imap_bounded(executor, fn, iterable, window):
+    """Like `executor.map`, but lazy: submits `fn(item)` for the items of
+    `iterable` while keeping at most `window` calls ahead of the consumer.
+    Yields `(item, future)` pairs in order."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def _chunks(iterable, size):
+    """Yields lists of up to `size` consecutive items of `iterable`."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_data_objects(base_url, service_url, data_object_ids, batch_size=100):
+    """Resolves data objects in batches through the bulk `dataobjects:batch`
+    endpoint instead of making one request per data object.
+    :param base_url:
+    :param service_url:
+    :param data_object_ids: (list) of data object IDs
+    :param batch_size: (int) number of data objects requested at once
+    :return: (list) of DSSDataObject, in the order of `data_object_ids`"""
+    data_objects = []
+    for i in range(0, len(data_object_ids), batch_size):
+        for data_object in get_data_object_batch(
+                base_url, service_url, data_object_ids[i:i + batch_size]):
+            if isinstance(data_object, Exception):
+                raise data_object
+            data_objects.append(data_object)
+    return data_objects
+
+
+# The services found not to have the `dataobjects:batch` endpoint, which are
+# asked for one data object at a time instead.
+_without_batch_endpoint = set()
+
+# What a deployment without the endpoint answers. API Gateway answers 403 for
+# routes it doesn't know.
+NO_BATCH_ENDPOINT_STATUS_CODES = frozenset([403, 404, 405])
+
+
+def get_data_object_batch(base_url, service_url, data_object_ids):
+    """Resolves a single batch of data objects through the bulk
+    `dataobjects:batch` endpoint, or one at a time if the service doesn't
+    have that endpoint.
+    :param base_url:
+    :param service_url:
+    :param data_object_ids: (list) of data object IDs
+    :return: (list) holding a DSSDataObject, or an exception if it could not
+        be resolved, for each of `data_object_ids`"""
+    batch_url = os.path.join(service_url, base_url, 'dataobjects:batch')
+    if batch_url not in _without_batch_endpoint:
+        r = get_session().post(batch_url,
+                               json={'data_object_ids': data_object_ids})
+        if r.status_code not in NO_BATCH_ENDPOINT_STATUS_CODES:
+            r.raise_for_status()
+            return _batch_to_data_objects(base_url, service_url,
+                                          data_object_ids, r.json())
+        _without_batch_endpoint.add(batch_url)
+    data_objects = []
+    for data_object_id in data_object_ids:
+        try:
+            data_objects.append(DSSDataObject(base_url, service_url,
+                                              data_object_id))
+        except Exception as e:
+            data_objects.append(e)
+    return data_objects
+
+
+def _batch_to_data_objects(base_url, service_url, data_object_ids, body):
+    data_objects = []
+    for data_object_id, item in zip(data_object_ids, body['data_objects']):
+        if 'data_object' in item:
+            data_objects.append(DSSDataObject(base_url, service_url,
+                                              data_object_id,
+                                              item['data_object']))
+        else:
+            data_objects.append(ValueError(item['msg']))
+    return data_objects
+
+
+class FetchError(Exception):
+    """Raised when some payload files could not be downloaded, after all
+    others were. Holds the failures."""
+
+    def __init__(self, failures):
+        super(FetchError, self).__init__(
+            '{} files could not be fetched: {}'.format(
+                len(failures), ', '.join(f.id for f in failures[:10])))
+        self.failures = failures
+
+
+class ChecksumMismatch(ValueError):
+    """Raised when a downloaded file doesn't match its checksum."""
+
+
+class NoHTTPURL(ValueError):
+    """Raised for a file that has no HTTP URL to download it from, like a
+    file by reference, which only has gs:// and s3:// URLs."""
+
+
+def fetch_payload(entries, data_dir, service_url, base_url, workers=8,
+                  batch_size=100, failures=None, ranking=None, skipped=None):
+    """Downloads the files of remote-file-manifest entries into `data_dir`,
+    up to `workers` at a time. Entries that point at a data object in the
+    service are resolved again in batches for the URLs of the data object,
+    and each file is fetched from the fastest replica that has it, see
+    `fetch_file`. Other entries, like those of a bundle manifest, are
+    fetched from their own URL.
+    Failures don't stop the other downloads; they are appended to `failures`
+    instead. Files without an HTTP URL are appended to `skipped`.
+    :param entries: (iterable) of RFM dictionaries
+    :param data_dir: directory to write the files to, by their `filename`
+    :param service_url:
+    :param base_url:
+    :param workers: (int) number of concurrent downloads
+    :param batch_size: (int) number of data objects requested at once
+    :param failures: (list) that RFMFailure are appended to
+    :param ranking: (ReplicaRanking) of the replicas, shared by all files
+    :param skipped: (list) that RFMFailure of skipped files are appended to
+    :return: (int) number of files fetched"""
+    if failures is None:
+        failures = []
+    if skipped is None:
+        skipped = []
+    if ranking is None:
+        ranking = ReplicaRanking()
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    data_objects_url = os.path.join(service_url, base_url, 'dataobjects', '')
+
+    def resolve_batch(batch):
+        # Entries that point at a data object in the service are resolved
+        # for the URLs of all replicas, others are fetched from their URL.
+        ids = [e['url'][len(data_objects_url):] for e in batch
+               if e['url'].startswith(data_objects_url)]
+        data_objects = iter(get_data_object_batch(base_url, service_url, ids)
+                            if ids else [])
+        return [next(data_objects) if e['url'].startswith(data_objects_url)
+                else [e['url']] for e in batch]
+
+    def iter_items(batches):
+        for batch, future in batches:
+            try:
+                data_objects = future.result()
+            except Exception as e:
+                data_objects = [e] * len(batch)
+            for item in zip(batch, data_objects):
+                yield item
+
+    def fetch(item):
+        entry, data_object = item
+        if isinstance(data_object, Exception):
+            raise data_object
+        if isinstance(data_object, list):
+            urls = data_object
+        else:
+            urls = [u['url'] for u in data_object.get_object()['urls']]
+        return fetch_file(entry, urls, data_dir, ranking)
+
+    n_fetched = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = _imap_bounded(executor, resolve_batch,
+                                _chunks(entries, batch_size), 2)
+        fetched = _imap_bounded(executor, fetch, iter_items(batches), workers)
+        for (entry, _), future in fetched:
+            try:
+                future.result()
+            except NoHTTPURL as e:
+                skipped.append(RFMFailure(entry['filename'], e))
+            except Exception as e:
+                failures.append(RFMFailure(entry['filename'], e))
+            else:
+                n_fetched += 1
+    return n_fetched
+
+
+def fetch_file(entry, urls, data_dir, ranking=None,
+               chunk_size=FETCH_CHUNK_SIZE):
+    """Downloads the file of a remote-file-manifest entry into `data_dir`,
+    trying its HTTP URLs fastest replica first until one succeeds.
+
+    Each chunk is written to disk and fed to the sha256, sha1 and crc32c
+    hashes of the entry in the same pass, and the file is only moved into
+    place once its length and checksums match. A partial download is kept
+    and resumed with a Range request on the next attempt. A file that is
+    already in place was verified then and is not fetched again.
+    :param entry: (dict) RFM dictionary of the file
+    :param urls: (list) of URLs of the file
+    :param data_dir: directory to write the file to
+    :param ranking: (ReplicaRanking) to order `urls` by and report to
+    :param chunk_size: (int) number of bytes to download and hash at once
+    :return: path of the file"""
+    path = os.path.join(data_dir, entry['filename'])
+    length = int(entry['length']) if entry.get('length') else None
+    if os.path.exists(path) and (length is None or
+                                 os.path.getsize(path) == length):
+        return path
+    candidates = [url for url in urls
+                  if urlparse(url).scheme in ('http', 'https')]
+    if not candidates:
+        raise NoHTTPURL('No HTTP URL to fetch {} from'.format(
+            entry['filename']))
+    if ranking:
+        candidates = ranking.order(candidates)
+    error = None
+    for url in candidates:
+        try:
+            seconds = _fetch_url(url, path, entry, length, chunk_size)
+        except Exception as e:
+            if ranking:
+                ranking.record_failure(url)
+            error = e
+        else:
+            if ranking and seconds is not None:
+                ranking.record(url, seconds)
+            return path
+    raise error
+
+
+def _fetch_url(url, path, entry, length, chunk_size):
+    """Downloads `url` to `path`, resuming a partial download, and verifies
+    it against `entry`.
+    :return: seconds until the response started, or None if nothing had to
+        be requested"""
+    part = path + '.part'
+    hashers = _make_hashers(entry)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset and (length is None or offset > length):
+        offset = 0
+    if offset:
+        # The bytes downloaded before have to be hashed again to resume.
+        with open(part, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+    seconds = None
+    if length is None or offset < length:
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        start = time.time()
+        with get_session().get(url, headers=headers, stream=True) as r:
+            seconds = time.time() - start
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                # The server ignored the range, so start over.
+                offset = 0
+                hashers = _make_hashers(entry)
+            with open(part, 'ab' if offset else 'wb') as fp:
+                for chunk in r.iter_content(chunk_size):
+                    fp.write(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+    size = os.path.getsize(part)
+    if length is not None and size != length:
+        raise IOError('Fetched {} of {} bytes of {} from {}'.format(
+            size, length, entry['filename'], url))
+    for alg, hasher in hashers.items():
+        if hasher.hexdigest() != entry[alg].lower():
+            os.remove(part)
+            raise ChecksumMismatch(
+                '{} of {} from {} is {}, expected {}'.format(
+                    alg, entry['filename'], url, hasher.hexdigest(),
+                    entry[alg]))
+    os.rename(part, path)
+    return seconds
+
+
+class _CRC32C:
+    """A hashlib-like wrapper of `crc32c.crc32c`."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+
+def _make_hashers(entry):
+    """
+    :return: (dict) of hashes for the checksums of `entry` we can verify"""
+    hashers = {alg: hashlib.new(alg) for alg in ('sha256', 'sha1')
+               if entry.get(alg)}
+    if crc32c and entry.get('crc32c'):
+        hashers['crc32c'] = _CRC32C()
+    return hashers
+
+
+class ReplicaRanking:
+    """Keeps a moving average of how long each replica takes to respond,
+    and orders the URLs of a file fastest replica first. A replica is
+    identified by the host and `replica` parameter of its URLs. Replicas
+    that weren't seen yet are probed with a HEAD request."""
+
+    # Counted as the response time of a replica that failed.
+    FAILURE_PENALTY = 60.0
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._seconds = {}
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+
+    @staticmethod
+    def replica(url):
+        parsed = urlparse(url)
+        return parsed.netloc, tuple(parse_qs(parsed.query).get('replica', []))
+
+    def record(self, url, seconds):
+        key = self.replica(url)
+        with self._lock:
+            previous = self._seconds.get(key)
+            self._seconds[key] = seconds if previous is None else \
+                previous + self.alpha * (seconds - previous)
+
+    def record_failure(self, url):
+        self.record(url, self.FAILURE_PENALTY)
+
+    def order(self, urls):
+        """
+        :return: (list) of `urls`, fastest replica first"""
+        with self._probe_lock:
+            for url in urls:
+                if self.replica(url) not in self._seconds:
+                    self._probe(url)
+        with self._lock:
+            seconds = dict(self._seconds)
+        return sorted(urls, key=lambda url: seconds.get(self.replica(url),
+                                                        self.FAILURE_PENALTY))
+
+    def _probe(self, url):
+        start = time.time()
+        try:
+            r = get_session().head(url, allow_redirects=False)
+        except Exception:
+            self.record_failure(url)
+        else:
+            if r.status_code < 400:
+                self.record(url, time.time() - start)
+            else:
+                self.record_failure(url)
 
 
 def create_dict_for_rfm(data_object, local_fname_id):
@@ -88,19 +907,17 @@ def create_dict_for_rfm(data_object, local_fname_id):
     length_ = data_object.get_file_size()
     filename_ = 'dss_data_object_' + str(local_fname_id)
 
-    keys = ['url', 'length', 'filename']
-    vals = [url_, length_, filename_]
-    d1 = dict(zip(keys, vals))
-    d2 = data_object.get_checksums()
-
-    return dict(d1, **d2)  # concatenate
+    d = {'url': url_, 'length': length_, 'filename': filename_}
+    d.update(data_object.get_checksums())
+    return d
 
 
 class DSSDataObject:
     """Contains methods to process DSS data objects to facilitate creation 
     BDBags using remote-file-manifest. """
 
-    def __init__(self, base_url, service_url, data_object_id):
+    def __init__(self, base_url, service_url, data_object_id,
+                 data_object=None):
         self.base_url = base_url
         self.service_url = service_url
         self.data_object_id = data_object_id
@@ -108,8 +925,12 @@ class DSSDataObject:
                                             self.base_url,
                                             'dataobjects',
                                             self.data_object_id)
-        self.data_object = requests.get(
-            self.data_object_url).json()['data_object']
+        # A data object that was already resolved, e.g. by a batch request,
+        # can be passed in to avoid fetching it again.
+        if data_object is None:
+            data_object = get_session().get(
+                self.data_object_url).json()['data_object']
+        self.data_object = data_object
 
     def get_object(self):
         """
@@ -126,22 +947,26 @@ class DSSDataObject:
         if 'size' in d.keys():
             if d['size']:
                 return d['size']
-        elif d['urls']:  # ...while in other objects we check in the first file.
-            if d['urls'][0]['url']:
-                file_url = d['urls'][0]['url']
-                r = requests.head(file_url)
+        elif d['urls']:  # ...while in other objects we check the files.
+            # The service lists the URLs of the fastest replica first, so
+            # the others are only tried if that one fails.
+            r = None
+            urls = [u['url'] for u in d['urls']]
+            for file_url in [url for url in urls
+                             if urlparse(url).scheme in ('http', 'https')]:
+                r = get_session().head(file_url)
                 if r.status_code == 200:
                     return r.headers['X-DSS-SIZE']
-                else:
-                    r.raise_for_status()
+            if r is not None:
+                r.raise_for_status()
 
     def get_checksums(self):
-        L = self.data_object  # list
-        if L['checksums']:
-            L = L['checksums']
-            checksum_types = [d['type'] for d in L]
-            check_sums = [d['checksum'] for d in L]
-            return dict(zip(checksum_types, check_sums))
+        """
+        :returns: a dictionary mapping checksum types to checksums, leaving
+        out checksums that are null, which bdbag would reject"""
+        return {d['type']: d['checksum']
+                for d in self.data_object.get('checksums') or []
+                if d['checksum']}
 
     def to_disk(self, json_fname):
         """
@@ -160,7 +985,8 @@ class DSSBundle:
     def __init__(self, service_url, base_url, data_bundle_id):
         self.bundle_url = os.path.join(service_url, base_url,
                                        'databundles', data_bundle_id)
-        self.data_bundle = requests.get(self.bundle_url).json()['data_bundle']
+        self.data_bundle = \
+            get_session().get(self.bundle_url).json()['data_bundle']
 
     def display(self):
         return pprint(self.data_bundle)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+from chalice.test import Client
+
+from benchmarks import fake_dss
+
+
+def import_app():
+    # dos-dss-lambda reads DSS_ENDPOINT when it is imported.
+    fake_dss.shared()
+    os.environ.setdefault('DOS_METRICS', 'false')
+    import app
+    return app
+
+
+class TestListHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.app = import_app()
+
+    def test_page_tokens_round_trip(self):
+        token = self.app.encode_page_token('abc', 7)
+        self.assertEqual(self.app.decode_page_token(token), ('abc', 7))
+        token = self.app.encode_manifest_token('2018-06-07T001704.000000Z', 100)
+        self.assertEqual(self.app.decode_manifest_token(token), ('2018-06-07T001704.000000Z', 100))
+
+    def test_parse_page_size(self):
+        self.assertEqual(self.app.parse_page_size(None, 10), 10)
+        self.assertEqual(self.app.parse_page_size({'page_size': '25'}, 10), 25)
+        for page_size in ('abc', '0', '-1'):
+            with self.assertRaises(ValueError):
+                self.app.parse_page_size({'page_size': page_size}, 10)
+
+    def test_no_filters(self):
+        self.assertEqual(self.app.make_list_filters({'page_size': '10'}), ({}, None))
+
+    def test_alias_and_checksum_filters(self):
+        es_query, predicate = self.app.make_list_filters({'alias': 'a.json', 'checksum': 'ABC',
+                                                          'checksum_type': 'sha256'})
+        self.assertEqual(es_query, {'query': {'bool': {'must': [
+            {'match': {'manifest.files.name': 'a.json'}},
+            {'bool': {'should': [{'match': {'manifest.files.sha256': 'ABC'}}], 'minimum_should_match': 1}}]}}})
+        self.assertTrue(predicate({'name': 'a.json', 'sha256': 'abc'}))
+        self.assertFalse(predicate({'name': 'b.json', 'sha256': 'abc'}))
+        self.assertFalse(predicate({'name': 'a.json', 'sha1': 'abc'}))
+
+    def test_checksum_type_alone_selects_files_that_have_one(self):
+        es_query, predicate = self.app.make_list_filters({'checksum_type': 'multipart-md5'})
+        self.assertEqual(es_query['query']['bool']['must'], [{'exists': {'field': 'manifest.files.s3_etag'}}])
+        self.assertTrue(predicate({'s3_etag': 'abc'}))
+        self.assertFalse(predicate({'sha256': 'abc'}))
+
+    def test_url_and_content_type_filters(self):
+        url = '{}/files/{}?replica=aws'.format(self.app.DSS_ENDPOINT, 'file-uuid')
+        _, predicate = self.app.make_list_filters({'url': url, 'content_type': 'application/json'})
+        self.assertTrue(predicate({'uuid': 'file-uuid', 'content-type': 'application/json; dss-type=fileref'}))
+        self.assertFalse(predicate({'uuid': 'other-uuid', 'content-type': 'application/json'}))
+
+    def test_untranslatable_filters(self):
+        for params in ({'checksum_type': 'md5'}, {'url': 's3://bucket/key'}):
+            with self.assertRaises(ValueError):
+                self.app.make_list_filters(params)
+
+
+class TestRoutes(unittest.TestCase):
+    """Serves the routes with :class:`chalice.test.Client` on top of a fake
+    DSS, see :mod:`benchmarks.fake_dss`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dss = fake_dss.shared()
+        cls.app = import_app()
+        cls.client = Client(cls.app.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def setUp(self):
+        from chalicelib.replicas import ReplicaTracker
+        self.catalog = fake_dss.Catalog(5, 3, fileref_every=4)
+        self.dss.catalog = self.catalog
+        self.dss.missing = {}
+        self.app.bundle_cache.clear()
+        self.app.reference_cache.clear()
+        self.app.replica_tracker = ReplicaTracker(self.app.REPLICAS)
+        self.file_uuid = sorted(self.catalog.files)[0]
+
+    def get(self, path, **headers):
+        response = self.client.http.get('/ga4gh/dos/v1/' + path, headers=headers)
+        body = response.body.decode('utf-8')
+        return response, json.loads(body) if response.headers.get('Content-Type') == 'application/json' else body
+
+    def test_get_data_object(self):
+        response, body = self.get('dataobjects/' + self.file_uuid)
+        self.assertEqual(response.status_code, 200)
+        data_object = body['data_object']
+        self.assertEqual(data_object['id'], self.file_uuid)
+        self.assertEqual(data_object['size'], str(self.catalog.files[self.file_uuid][1]['size']))
+        # A DSS URL and a native URL for each replica
+        urls = [url['url'] for url in data_object['urls']]
+        self.assertEqual(len(urls), 2 * len(self.app.REPLICAS))
+        for replica in self.app.REPLICAS:
+            self.assertTrue(any(url.startswith('{}/files/{}?replica={}'.format(self.app.DSS_ENDPOINT, self.file_uuid,
+                                                                                 replica)) for url in urls))
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response, _ = self.get('dataobjects/' + self.file_uuid, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_data_object_missing_from_a_replica(self):
+        self.dss.missing = {self.app.REPLICAS[0]: {self.file_uuid}}
+        response, body = self.get('dataobjects/' + self.file_uuid)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['data_object']['id'], self.file_uuid)
+
+    def test_get_pinned_file_reference_from_the_cache(self):
+        fileref = next(uuid for uuid, (_, dss_file) in sorted(self.catalog.files.items())
+                       if 'fileref' in dss_file['content-type'])
+        path = 'dataobjects/{}?version={}'.format(fileref, fake_dss.VERSION)
+        response, body = self.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], self.app.PINNED_CACHE_CONTROL)
+        # The reference JSON of the pinned version is cached, so DSS isn't
+        # asked at all the next time.
+        self.dss.requests = {}
+        response, cached_body = self.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cached_body, body)
+        self.assertEqual(response.headers['Cache-Control'], self.app.PINNED_CACHE_CONTROL)
+        self.assertEqual(self.dss.requests, {})
+        # Other files list the replicas fastest first.
+        response, _ = self.get('dataobjects/{}?version={}'.format(self.file_uuid, fake_dss.VERSION))
+        self.assertEqual(response.headers['Cache-Control'], self.app.ORDERED_CACHE_CONTROL)
+
+    def test_get_missing_data_object(self):
+        response, _ = self.get('dataobjects/nonexistent')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_data_objects_in_a_batch(self):
+        ids = [self.file_uuid, 'nonexistent']
+        response = self.client.http.post('/ga4gh/dos/v1/dataobjects:batch',
+                                         headers={'Content-Type': 'application/json'},
+                                         body=json.dumps({'data_object_ids': ids}))
+        self.assertEqual(response.status_code, 200)
+        data_objects = json.loads(response.body.decode('utf-8'))['data_objects']
+        self.assertEqual(data_objects[0]['data_object']['id'], self.file_uuid)
+        self.assertEqual(data_objects[1]['data_object_id'], 'nonexistent')
+        self.assertEqual(data_objects[1]['status_code'], 404)
+
+    def test_invalid_batch_requests(self):
+        for body in ({'data_object_ids': self.file_uuid}, {'data_object_ids': [{'a': 1}]},
+                     {'data_object_ids': [1]}, {'data_object_ids': [self.file_uuid], 'versions': {'x': ['a']}},
+                     {'data_object_ids': [self.file_uuid], 'versions': [self.file_uuid]}):
+            response = self.client.http.post('/ga4gh/dos/v1/dataobjects:batch',
+                                             headers={'Content-Type': 'application/json'},
+                                             body=json.dumps(body))
+            self.assertEqual(response.status_code, 400, body)
+
+    def test_list_data_objects_pages(self):
+        ids = []
+        path = 'dataobjects?page_size=4'
+        while True:
+            response, body = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(body['data_objects']), 4)
+            ids.extend(data_object['id'] for data_object in body['data_objects'])
+            if not body['next_page_token']:
+                break
+            path = 'dataobjects?page_size=4&page_token=' + body['next_page_token']
+        self.assertEqual(sorted(ids), sorted(self.catalog.files))
+
+    def test_list_data_objects_from_raw_search_hits(self):
+        self.dss.catalog = self.catalog = fake_dss.Catalog(25, 3)
+        self.dss.requests = {}
+        response, body = self.get('dataobjects?page_size=4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(body['data_objects']), 4)
+        # The bundles come with their manifests, and the next page of search
+        # results is prefetched at most.
+        self.assertNotIn('GET v1/bundles', self.dss.requests)
+        self.assertLessEqual(self.dss.requests['POST v1/search'], 2)
+        ids = []
+        path = 'dataobjects?page_size=7'
+        while path:
+            response, body = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(data_object['id'] for data_object in body['data_objects'])
+            path = body['next_page_token'] and 'dataobjects?page_size=7&page_token=' + body['next_page_token']
+        self.assertEqual(sorted(ids), sorted(self.catalog.files))
+        self.assertEqual(len(ids), len(self.catalog.files))
+
+    def test_list_data_objects_filters_files(self):
+        response, body = self.get('dataobjects?page_size=100&alias=file_1.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(body['data_objects']), 5)
+        self.assertEqual({data_object['name'] for data_object in body['data_objects']}, {'file_1.json'})
+
+    def test_list_data_objects_skips_bundles_that_cant_be_fetched(self):
+        search = self.app.search
+
+        def search_with_missing_bundle(*args, **kwargs):
+            results, next_search_after = search(*args, **kwargs)
+            return [{'bundle_fqid': 'nonexistent.{}'.format(fake_dss.VERSION)}] + results, next_search_after
+
+        with mock.patch.object(self.app, 'search', search_with_missing_bundle):
+            response, body = self.get('dataobjects?page_size=100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(body['data_objects']), len(self.catalog.files))
+
+    def test_invalid_list_requests(self):
+        for path in ('dataobjects?page_size=abc', 'dataobjects?page_token=abc', 'dataobjects?checksum_type=md5',
+                     'databundles?page_size=0', 'databundles?page_size=9', 'databundles?page_size=501'):
+            response, _ = self.get(path)
+            self.assertEqual(response.status_code, 400, path)
+
+    def test_list_expanded_data_bundles(self):
+        response, body = self.get('databundles?page_size=10&expand=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([bundle['id'] for bundle in body['data_bundles']], self.catalog.bundle_order)
+        for bundle in body['data_bundles']:
+            self.assertEqual(bundle['data_object_ids'],
+                             [dss_file['uuid'] for dss_file in self.catalog.bundles[bundle['id']]['files']])
+
+    def test_list_expanded_data_bundles_larger_than_a_raw_page(self):
+        self.dss.catalog = self.catalog = fake_dss.Catalog(25, 3)
+        response, body = self.get('databundles?page_size=20&expand=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(body['data_bundles']), 20)
+        for bundle in body['data_bundles']:
+            self.assertEqual(bundle['data_object_ids'],
+                             [dss_file['uuid'] for dss_file in self.catalog.bundles[bundle['id']]['files']])
+
+    def test_list_expanded_data_bundles_reports_failures_per_bundle(self):
+        search = self.app.search
+
+        def search_with_missing_bundle(*args, **kwargs):
+            results, next_search_after = search(*args, **kwargs)
+            return results + [{'bundle_fqid': 'nonexistent.{}'.format(fake_dss.VERSION)}], next_search_after
+
+        with mock.patch.object(self.app, 'search', search_with_missing_bundle):
+            response, body = self.get('databundles?page_size=10&expand=true')
+        self.assertEqual(response.status_code, 200)
+        missing = body['data_bundles'][-1]
+        self.assertEqual(missing['id'], 'nonexistent')
+        self.assertEqual(missing['status_code'], 404)
+        self.assertNotIn('data_object_ids', missing)
+        self.assertTrue(all('data_object_ids' in bundle for bundle in body['data_bundles'][:-1]))
+
+    def test_get_data_bundle(self):
+        bundle_uuid = self.catalog.bundle_order[0]
+        response, body = self.get('databundles/' + bundle_uuid)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['data_bundle']['data_object_ids'],
+                         [dss_file['uuid'] for dss_file in self.catalog.bundles[bundle_uuid]['files']])
+        response, _ = self.get('databundles/nonexistent')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_data_bundle_manifest_pages(self):
+        bundle_uuid = self.catalog.bundle_order[0]
+        response, body = self.get('databundles/{}/manifest?page_size=2'.format(bundle_uuid))
+        self.assertEqual(response.status_code, 200)
+        entries = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(entries), 2)
+        link = response.headers['Link']
+        next_page = link[link.index('<') + 1:link.index('>')]
+        response, body = self.get('databundles/{}/{}'.format(bundle_uuid, next_page))
+        entries.extend(json.loads(line) for line in body.splitlines())
+        self.assertNotIn('Link', response.headers)
+        self.assertEqual([entry['filename'] for entry in entries], ['file_0.json', 'file_1.json', 'file_2.json'])
+
+    def test_get_data_bundle_manifest_passes_on_client_errors(self):
+        bundle_uuid = self.catalog.bundle_order[0]
+        response, _ = self.get('databundles/nonexistent/manifest')
+        self.assertEqual(response.status_code, 404)
+        forbidden = requests.Response()
+        forbidden.status_code = 403
+        with mock.patch.object(self.app, 'get_bundle', side_effect=requests.HTTPError(response=forbidden)):
+            response, body = self.get('databundles/{}/manifest'.format(bundle_uuid))
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(bundle_uuid, body['msg'])
+
+    def test_get_data_bundle_manifest_with_unresolvable_file_reference(self):
+        bundle_uuid, fileref = next((bundle_uuid, dss_file) for bundle_uuid in self.catalog.bundle_order
+                                    for dss_file in self.catalog.bundles[bundle_uuid]['files']
+                                    if 'fileref' in dss_file['content-type'])
+        self.dss.missing = {replica: {fileref['uuid']} for replica in self.app.REPLICAS}
+        response, body = self.get('databundles/{}/manifest'.format(bundle_uuid))
+        self.assertEqual(response.status_code, 502)
+        self.assertIn(fileref['uuid'], body['msg'])
+
+    def test_metrics_are_emitted_when_a_view_raises(self):
+        with mock.patch.object(self.app, 'search', side_effect=RuntimeError('DSS is down')), \
+                mock.patch('chalicelib.metrics.emit') as emit:
+            response, _ = self.get('databundles')
+        self.assertEqual(response.status_code, 500)
+        request_metrics, = emit.call_args[0]
+        self.assertEqual(request_metrics.status_code, 500)
+        self.assertIsNotNone(request_metrics.finished_at)
+
+
+class TestFileIndex(unittest.TestCase):
+    """Builds the file index of :mod:`chalicelib.index` against the fake DSS
+    and resolves Data Objects and Data Bundles from it."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dss = fake_dss.shared()
+        cls.app = import_app()
+        cls.client = Client(cls.app.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def setUp(self):
+        from chalicelib.index import build_index, FileIndex
+        from chalicelib.replicas import ReplicaTracker
+        self.catalog = fake_dss.Catalog(5, 3, fileref_every=4)
+        self.dss.catalog = self.catalog
+        self.dss.missing = {}
+        self.app.bundle_cache.clear()
+        self.app.reference_cache.clear()
+        self.app.replica_tracker = ReplicaTracker(self.app.REPLICAS)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'dss-index.sqlite')
+        self.added = build_index(self.path, self.app.REPLICAS, per_page=10)
+        self.index = FileIndex(self.path)
+        patcher = mock.patch.object(self.app, '_file_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dss.requests = {}
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, path):
+        with mock.patch('chalicelib.metrics.emit') as emit:
+            response = self.client.http.get('/ga4gh/dos/v1/' + path)
+        request_metrics, = emit.call_args[0]
+        return response, json.loads(response.body.decode('utf-8')), request_metrics
+
+    def files(self, fileref):
+        return [dss_file for bundle_uuid in self.catalog.bundle_order
+                for dss_file in self.catalog.bundles[bundle_uuid]['files']
+                if ('fileref' in dss_file['content-type']) == fileref]
+
+    def test_refresh_only_fetches_bundles_that_arent_indexed(self):
+        from chalicelib.index import build_index
+        self.assertEqual(self.added, 5)
+        self.assertEqual(build_index(self.path, self.app.REPLICAS, per_page=10), 0)
+        self.assertNotIn('GET v1/bundles', self.dss.requests)
+        self.dss.catalog = fake_dss.Catalog(7, 3, fileref_every=4)
+        self.assertEqual(build_index(self.path, self.app.REPLICAS, per_page=10), 2)
+        self.assertEqual(self.dss.requests['GET v1/bundles'], 2 * len(self.app.REPLICAS))
+
+    def test_get_file(self):
+        bundle_uuid = self.catalog.bundle_order[0]
+        dss_file = self.catalog.bundles[bundle_uuid]['files'][1]
+        indexed_file = self.index.get_file(dss_file['uuid'])
+        self.assertEqual((indexed_file['bundle_uuid'], indexed_file['bundle_version']), (bundle_uuid, fake_dss.VERSION))
+        for key in ('uuid', 'version', 'name', 'size', 'content-type', 'sha256', 's3_etag', 'sha1', 'crc32c'):
+            self.assertEqual(indexed_file[key], dss_file[key], key)
+        self.assertEqual(sorted(indexed_file['urls']), sorted(self.app.REPLICAS))
+        self.assertEqual(self.index.get_file(dss_file['uuid'], fake_dss.VERSION)['uuid'], dss_file['uuid'])
+        self.assertIsNone(self.index.get_file(dss_file['uuid'], '2000-01-01T000000.000000Z'))
+        self.assertIsNone(self.index.get_file('nonexistent'))
+
+    def test_get_bundle_files(self):
+        bundle_uuid = self.catalog.bundle_order[0]
+        files = self.index.get_bundle_files(bundle_uuid, fake_dss.VERSION)
+        self.assertEqual([dss_file['uuid'] for dss_file in files],
+                         [dss_file['uuid'] for dss_file in self.catalog.bundles[bundle_uuid]['files']])
+        self.assertIsNone(self.index.get_bundle_files(bundle_uuid, '2000-01-01T000000.000000Z'))
+        self.assertIsNone(self.index.get_bundle_files('nonexistent', fake_dss.VERSION))
+
+    def test_indexed_data_objects_are_resolved_without_dss(self):
+        dss_file = self.files(fileref=False)[0]
+        response, body, request_metrics = self.get('dataobjects/' + dss_file['uuid'])
+        self.assertEqual(response.status_code, 200)
+        data_object = body['data_object']
+        self.assertEqual((data_object['id'], data_object['size']), (dss_file['uuid'], str(dss_file['size'])))
+        urls = [url['url'] for url in data_object['urls']]
+        for replica in self.app.REPLICAS:
+            self.assertTrue(any(url.startswith('{}/files/{}?replica={}'.format(self.app.DSS_ENDPOINT,
+                                                                                 dss_file['uuid'], replica))
+                                for url in urls))
+        self.assertEqual(len(urls), 2 * len(self.app.REPLICAS))
+        self.assertEqual(self.dss.requests, {})
+        self.assertEqual(request_metrics.cache['index'], {'hits': 1})
+
+    def test_file_references_and_unindexed_files_are_resolved_live(self):
+        fileref = self.files(fileref=True)[0]
+        response, body, request_metrics = self.get('dataobjects/' + fileref['uuid'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body['data_object']['id'], fileref['uuid'])
+        self.assertIn('HEAD v1/files', self.dss.requests)
+        self.assertEqual(request_metrics.cache['index'], {'misses': 1})
+        response, _, request_metrics = self.get('dataobjects/nonexistent')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(request_metrics.cache['index'], {'misses': 1})
+
+    def test_search_hits_are_expanded_from_the_index(self):
+        response, body, request_metrics = self.get('databundles?page_size=20&expand=true')
+        self.assertEqual(response.status_code, 200)
+        for bundle in body['data_bundles']:
+            self.assertEqual(bundle['data_object_ids'],
+                             [dss_file['uuid'] for dss_file in self.catalog.bundles[bundle['id']]['files']])
+        self.assertNotIn('GET v1/bundles', self.dss.requests)
+        self.assertEqual(request_metrics.cache['index'], {'hits': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent import futures
+from unittest import mock
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.response import HTTPResponse
+
+from chalicelib import metrics, sessions
+from chalicelib.cache import DSSCache
+from chalicelib.replicas import CLOSED, HALF_OPEN, OPEN, ReplicaTracker
+from chalicelib.singleflight import SingleFlight
+
+
+class FakeClock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.request_metrics = metrics.begin('test')
+        self.single_flight = SingleFlight()
+        self.executor = futures.ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def start_waiters(self, fn, n):
+        # The leader blocks in fn until released, so the others have to wait
+        # for it.
+        leader = self.executor.submit(metrics.bound(self.single_flight.do), 'key', fn)
+        self.entered.wait(5)
+        waiters = [self.executor.submit(metrics.bound(self.single_flight.do), 'key', fn)
+                   for _ in range(n)]
+        while self.request_metrics.coalesced['shared'] < n:
+            time.sleep(0.01)
+        self.release.set()
+        return [leader] + waiters
+
+    def test_concurrent_calls_share_the_result(self):
+        calls = []
+        self.entered, self.release = threading.Event(), threading.Event()
+
+        def fn():
+            calls.append(1)
+            self.entered.set()
+            self.release.wait(5)
+            return {'bundle': 'b'}
+
+        results = [future.result(5) for future in self.start_waiters(fn, 3)]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'bundle': 'b'}] * 4)
+        self.assertEqual(self.request_metrics.coalesced, {'issued': 1, 'shared': 3})
+        self.assertEqual(len(self.single_flight), 0)
+
+    def test_concurrent_calls_share_the_error(self):
+        self.entered, self.release = threading.Event(), threading.Event()
+
+        def fn():
+            self.entered.set()
+            self.release.wait(5)
+            raise ValueError('DSS is down')
+
+        for future in self.start_waiters(fn, 2):
+            with self.assertRaises(ValueError):
+                future.result(5)
+        self.assertEqual(len(self.single_flight), 0)
+
+    def test_calls_after_the_first_finished_run_again(self):
+        self.assertEqual(self.single_flight.do('key', lambda: 1), 1)
+        self.assertEqual(self.single_flight.do('key', lambda: 2), 2)
+        self.assertEqual(self.request_metrics.coalesced, {'issued': 2})
+
+
+class TestDSSCache(unittest.TestCase):
+
+    def setUp(self):
+        self.request_metrics = metrics.begin('test')
+        self.clock = FakeClock()
+
+    def test_unversioned_entries_expire(self):
+        cache = DSSCache(ttl=10, clock=self.clock)
+        cache.put(('uuid', None, 'aws'), 'latest')
+        cache.put(('uuid', 'v1', 'aws'), 'pinned')
+        self.clock.advance(10)
+        self.assertEqual(cache.get(('uuid', None, 'aws')), 'latest')
+        self.clock.advance(1)
+        self.assertIsNone(cache.get(('uuid', None, 'aws')))
+        self.assertEqual(cache.get(('uuid', 'v1', 'aws')), 'pinned')
+        self.assertEqual(self.request_metrics.cache['cache'], {'hits': 2, 'misses': 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = DSSCache(max_size=2, clock=self.clock)
+        cache.put(('a', 'v1', 'aws'), 1)
+        cache.put(('b', 'v1', 'aws'), 2)
+        cache.get(('a', 'v1', 'aws'))
+        cache.put(('c', 'v1', 'aws'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(('b', 'v1', 'aws')))
+        self.assertEqual(cache.get(('a', 'v1', 'aws')), 1)
+        self.assertEqual(cache.get(('c', 'v1', 'aws')), 3)
+
+    def test_get_or_load_loads_on_miss_only(self):
+        cache = DSSCache(ttl=10, clock=self.clock)
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_load(('a', None, 'aws'), loader), 1)
+        self.assertEqual(cache.get_or_load(('a', None, 'aws'), loader), 1)
+        self.clock.advance(11)
+        self.assertEqual(cache.get_or_load(('a', None, 'aws'), loader), 2)
+
+    def test_stale_entries_are_served_while_refreshed(self):
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        cache = DSSCache(ttl=10, stale_ttl=20, clock=self.clock, executor=executor)
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            if len(calls) > 1:
+                release.wait(5)
+            return len(calls)
+
+        key = ('a', None, 'aws')
+        self.assertEqual(cache.get_or_load(key, loader), 1)
+        self.clock.advance(15)
+        # Expired, but within the stale window: the old value is returned
+        # right away, and a single refresh is started however often it's asked for.
+        self.assertEqual(cache.get_or_load(key, loader), 1)
+        self.assertEqual(cache.get_or_load(key, loader), 1)
+        release.set()
+        # The single worker gets to this once the refresh is done.
+        executor.submit(lambda: None).result(5)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.get_or_load(key, loader), 2)
+
+    def test_failed_refresh_keeps_the_stale_entry(self):
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        cache = DSSCache(ttl=10, stale_ttl=20, clock=self.clock, executor=executor)
+        key = ('a', None, 'aws')
+        cache.put(key, 'old')
+        self.clock.advance(15)
+
+        def loader():
+            raise IOError('DSS is down')
+
+        self.assertEqual(cache.get_or_load(key, loader), 'old')
+        executor.submit(lambda: None).result(5)
+        self.assertEqual(cache.get_or_load(key, loader), 'old')
+
+    def test_entries_too_old_to_serve_stale_are_reloaded(self):
+        cache = DSSCache(ttl=10, stale_ttl=20, clock=self.clock)
+        key = ('a', None, 'aws')
+        cache.put(key, 'old')
+        self.clock.advance(31)
+        self.assertEqual(cache.get_or_load(key, lambda: 'new'), 'new')
+
+
+class TestDSSCacheOnDisk(unittest.TestCase):
+
+    def setUp(self):
+        metrics.begin('test')
+        self.clock = FakeClock()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def entry_count(self):
+        return len([fname for fname in os.listdir(self.directory) if fname.endswith('.json')])
+
+    def test_entries_are_read_back_from_disk(self):
+        DSSCache(directory=self.directory, clock=self.clock).put(('a', 'v1', 'aws'), {'files': []})
+        cache = DSSCache(directory=self.directory, clock=self.clock)
+        self.assertEqual(cache.get(('a', 'v1', 'aws')), {'files': []})
+
+    def test_expired_entries_on_disk_are_deleted(self):
+        cache = DSSCache(ttl=10, directory=self.directory, clock=self.clock)
+        cache.put(('a', None, 'aws'), 'latest')
+        cache.clear()
+        self.clock.advance(11)
+        self.assertIsNone(cache.get(('a', None, 'aws')))
+        self.assertEqual(self.entry_count(), 0)
+
+    def test_directory_is_bounded(self):
+        cache = DSSCache(directory=self.directory, clock=self.clock, max_disk_bytes=1000, disk_low_water=0.5)
+        for i in range(50):
+            cache.put(('uuid{}'.format(i), 'v1', 'aws'), 'x' * 50)
+        size = sum(os.path.getsize(os.path.join(self.directory, fname)) for fname in os.listdir(self.directory))
+        self.assertLessEqual(size, 1000)
+        self.assertGreater(self.entry_count(), 0)
+        cache.clear()
+        # The newest entries are the ones kept.
+        self.assertIsNotNone(cache.get(('uuid49', 'v1', 'aws')))
+        self.assertIsNone(cache.get(('uuid0', 'v1', 'aws')))
+
+    def test_entries_read_from_disk_are_evicted_last(self):
+        cache = DSSCache(directory=self.directory, clock=self.clock, max_disk_bytes=1000, disk_low_water=0.5)
+        cache.put(('first', 'v1', 'aws'), 'x' * 50)
+        for path in os.listdir(self.directory):
+            # Make it look old, then use it again.
+            os.utime(os.path.join(self.directory, path), (0, 0))
+        for i in range(5):
+            cache.put(('uuid{}'.format(i), 'v1', 'aws'), 'x' * 50)
+        cache.clear()
+        self.assertIsNotNone(cache.get(('first', 'v1', 'aws')))
+        for i in range(20):
+            cache.put(('more{}'.format(i), 'v1', 'aws'), 'x' * 50)
+        cache.clear()
+        self.assertIsNone(cache.get(('uuid0', 'v1', 'aws')))
+
+
+class TestReplicaTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = ReplicaTracker(['aws', 'gcp'], failure_threshold=3, cooldown=30, clock=self.clock)
+
+    def state(self, replica):
+        return self.tracker.snapshot()[replica]['state']
+
+    def test_replicas_are_ordered_by_expected_latency(self):
+        self.assertEqual(self.tracker.available(), ['aws', 'gcp'])
+        self.tracker.record('aws', 0.15)
+        self.tracker.record('gcp', 0.1)
+        self.assertEqual(self.tracker.available(), ['gcp', 'aws'])
+        # Errors make a replica look slower.
+        for _ in range(2):
+            self.tracker.record('gcp', 0.1, ok=False)
+        self.assertEqual(self.tracker.available(), ['aws', 'gcp'])
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.tracker.record('gcp', 0.1, ok=False)
+        self.assertEqual(self.state('gcp'), CLOSED)
+        self.tracker.record('gcp', 0.1, ok=False)
+        self.assertEqual(self.state('gcp'), OPEN)
+        self.assertEqual(self.tracker.available(), ['aws'])
+        self.assertEqual(self.tracker.ordered(), ['aws', 'gcp'])
+
+    def test_success_resets_the_failure_count(self):
+        for ok in (False, False, True, False, False):
+            self.tracker.record('gcp', 0.1, ok=ok)
+        self.assertEqual(self.state('gcp'), CLOSED)
+
+    def test_slow_calls_count_as_failures(self):
+        tracker = ReplicaTracker(['aws'], failure_threshold=1, slow=1, clock=self.clock)
+        tracker.record('aws', 2)
+        self.assertEqual(tracker.snapshot()['aws']['state'], OPEN)
+
+    def open_circuit(self, replica):
+        for _ in range(3):
+            self.tracker.record(replica, 0.1, ok=False)
+
+    def test_circuit_half_opens_for_a_single_trial_after_cooldown(self):
+        self.open_circuit('gcp')
+        self.clock.advance(29)
+        self.assertEqual(self.tracker.available(), ['aws'])
+        self.clock.advance(1)
+        self.assertIn('gcp', self.tracker.available())
+        self.assertEqual(self.state('gcp'), HALF_OPEN)
+        # Only one trial call is let through at a time.
+        self.assertEqual(self.tracker.available(), ['aws'])
+
+    def test_successful_trial_closes_the_circuit(self):
+        self.open_circuit('gcp')
+        self.clock.advance(30)
+        self.tracker.available()
+        self.tracker.record('gcp', 0.1)
+        self.assertEqual(self.state('gcp'), CLOSED)
+        self.assertIn('gcp', self.tracker.available())
+
+    def test_failed_trial_opens_the_circuit_again(self):
+        self.open_circuit('gcp')
+        self.clock.advance(30)
+        self.tracker.available()
+        self.tracker.record('gcp', 0.1, ok=False)
+        self.assertEqual(self.state('gcp'), OPEN)
+        self.clock.advance(29)
+        self.assertEqual(self.tracker.available(), ['aws'])
+
+    def test_abandoned_trial_is_retried_after_cooldown(self):
+        self.open_circuit('gcp')
+        self.clock.advance(30)
+        self.tracker.available()
+        self.clock.advance(30)
+        self.assertIn('gcp', self.tracker.available())
+
+    def test_all_replicas_are_returned_if_all_are_open(self):
+        self.open_circuit('aws')
+        self.open_circuit('gcp')
+        self.assertEqual(sorted(self.tracker.available()), ['aws', 'gcp'])
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(sessions, 'metrics', sessions.SessionMetrics())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_idempotent_requests_are_retried(self):
+        policy = sessions.make_retry()
+        for status in sessions.RETRY_STATUS_CODES:
+            self.assertTrue(policy.is_retry('GET', status))
+            self.assertTrue(policy.is_retry('HEAD', status))
+            self.assertFalse(policy.is_retry('POST', status))
+        self.assertFalse(policy.is_retry('GET', 404))
+
+    def test_redirects_are_retried_after_the_time_dss_asks_for(self):
+        policy = sessions.make_retry()
+        self.assertTrue(policy.is_retry('GET', 301, has_retry_after=True))
+        self.assertFalse(policy.is_retry('GET', 301))
+        self.assertFalse(policy.is_retry('POST', 301, has_retry_after=True))
+
+    def test_backoff_is_jittered_up_to_the_exponential_backoff(self):
+        policy = sessions.make_retry(total=10, backoff_factor=1)
+        for _ in range(3):
+            policy = policy.increment('GET', '/v1/files', HTTPResponse(status=503))
+        backoff = super(sessions.JitteredRetry, policy).get_backoff_time()
+        self.assertEqual(backoff, 4)
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual(policy.get_backoff_time(), backoff)
+        samples = [policy.get_backoff_time() for _ in range(100)]
+        self.assertTrue(all(0 <= sample <= backoff for sample in samples))
+        self.assertGreater(len(set(samples)), 1)
+
+    def test_retries_are_counted_when_they_are_made(self):
+        policy = sessions.make_retry(total=1)
+        policy = policy.increment('GET', '/v1/files', HTTPResponse(status=503))
+        self.assertEqual(self.metrics.retries, {'GET': 1})
+        with self.assertRaises(MaxRetryError):
+            policy.increment('GET', '/v1/files', HTTPResponse(status=503))
+        self.assertEqual(self.metrics.retries, {'GET': 1})
+
+    def test_default_timeouts(self):
+        adapter = sessions.TimeoutHTTPAdapter()
+        with mock.patch.object(HTTPAdapter, 'send') as send:
+            adapter.send(mock.sentinel.request)
+            self.assertEqual(send.call_args[1]['timeout'], (sessions.CONNECT_TIMEOUT, sessions.READ_TIMEOUT))
+            adapter.send(mock.sentinel.request, timeout=1)
+            self.assertEqual(send.call_args[1]['timeout'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 
 import unittest
+from unittest import mock
 import os
+import hashlib
 import json
 import requests
 import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from bdbag import bdbag_api
 from remote_to_bag import DSSBundle as Bundle
 from remote_to_bag import DSSDataObject as DataObject
+from remote_to_bag import RFMBuildError, RFMCheckpoint, ReplicaRanking
+from remote_to_bag import ChecksumMismatch, NoHTTPURL, fetch_file, \
+    fetch_payload
 from remote_to_bag import create_dict_for_rfm, \
-    create_list_of_dicts_for_rfm, make_bag
+    create_list_of_dicts_for_rfm, get_data_objects, make_bag, build_rfm, \
+    iter_manifest_entries, write_rfm
+from benchmarks import fake_dss
 
 class Test_RemoteToBag(unittest.TestCase):
 
@@ -72,6 +82,48 @@ class Test_RemoteToBag(unittest.TestCase):
             rfm = json.load(fp)
         self.assertListEqual(self.remote_file_manifest, rfm)
 
+    def test_write_rfm(self):
+        with open(self.rfm_fname, 'w') as fp:
+            n = write_rfm(iter(self.remote_file_manifest), fp)
+        self.assertEqual(n, 2)
+        with open(self.rfm_fname) as fp:
+            self.assertListEqual(json.load(fp), self.remote_file_manifest)
+        with open(self.rfm_fname, 'w') as fp:
+            write_rfm(iter(self.remote_file_manifest), fp, json_lines=True)
+        with open(self.rfm_fname) as fp:
+            self.assertListEqual([json.loads(line) for line in fp],
+                                 self.remote_file_manifest)
+
+    def test_checkpoint(self):
+        fname = os.path.join(os.getcwd(), 'checkpoint.db')
+        try:
+            checkpoint = RFMCheckpoint(fname)
+            checkpoint.add_bundle('bundle', ['a', 'b'])
+            checkpoint.add_entry('a', self.remote_file_manifest[0])
+            checkpoint.close()
+            checkpoint = RFMCheckpoint(fname)
+            self.assertEqual(checkpoint.get_bundle('bundle'), ['a', 'b'])
+            self.assertIsNone(checkpoint.get_bundle('other'))
+            self.assertDictEqual(checkpoint.get_entries(['a', 'b']),
+                                 {'a': self.remote_file_manifest[0]})
+            checkpoint.add_manifest('bundle', self.remote_file_manifest)
+            self.assertListEqual(checkpoint.get_manifest('bundle'),
+                                 self.remote_file_manifest)
+            self.assertIsNone(checkpoint.get_manifest('other'))
+            checkpoint.close()
+        finally:
+            os.remove(fname)
+
+    def test_replica_ranking(self):
+        aws = 'https://dss.example.org/v1/files/a?replica=aws'
+        gcp = 'https://dss.example.org/v1/files/a?replica=gcp'
+        ranking = ReplicaRanking()
+        ranking.record(aws, 0.5)
+        ranking.record(gcp, 0.1)
+        self.assertEqual(ranking.order([aws, gcp]), [gcp, aws])
+        ranking.record_failure(gcp)
+        self.assertEqual(ranking.order([aws, gcp]), [aws, gcp])
+
     def test_make_bag_api(self):
         """This is NOT a test of a method in RemoteToBag class!! It only
         tests whether we can create a bag from the remote-file-manifest at
@@ -95,6 +147,29 @@ class Test_RemoteToBag(unittest.TestCase):
         self.assertTrue(type(L[0] == dict))
         self.assertEqual(len(L), 9)
 
+    def test_build_rfm(self):
+        progress = []
+        L, failures = build_rfm(self.list_of_bundles + [{'id': 'nonexistent'}],
+                                self.service_url, self.base_url, workers=4,
+                                progress=lambda done, total:
+                                progress.append((done, total)))
+        self.assertEqual(len(L), 9)
+        self.assertEqual([d['filename'] for d in L],
+                         ['dss_data_object_' + str(i) for i in range(9)])
+        self.assertEqual([f.id for f in failures], ['nonexistent'])
+        self.assertEqual(progress[-1], (9, 9))
+
+    def test_build_rfm_dedupe(self):
+        membership = {}
+        L, failures = build_rfm(self.list_of_bundles * 2, self.service_url,
+                                self.base_url, membership=membership)
+        self.assertEqual(len(L), 9)
+        self.assertEqual(failures, [])
+        self.assertEqual(set(membership),
+                         set(b['id'] for b in self.list_of_bundles))
+        self.assertEqual(sorted(f for fs in membership.values() for f in fs),
+                         sorted(d['filename'] for d in L))
+
     def test_make_bag(self):
         # Write a bag into the current directory.
         # TODO: create better test, e.g., compare the bag to existing bag
@@ -166,3 +241,282 @@ class TestDSSDataObject(unittest.TestCase):
         d = dataobject.get_checksums()
         self.assertEqual(d['sha1'], '05f818a54510272c17dcda69c948f8d904b5aae3')
 
+    def test_get_checksums_without_nulls(self):
+        data_object = {'checksums': [{'checksum': 'abc', 'type': 'sha1'},
+                                     {'checksum': None, 'type': 'sha256'}]}
+        dataobject = DataObject(self.base_url,
+                                self.service_url,
+                                self.data_object_id1,
+                                data_object=data_object)
+        self.assertDictEqual(dataobject.get_checksums(), {'sha1': 'abc'})
+        dataobject.data_object = {'checksums': None}
+        self.assertDictEqual(dataobject.get_checksums(), {})
+
+    def test_get_data_objects(self):
+        ids = [self.data_object_id1, self.data_object_id2,
+               self.data_object_id1]
+        dataobjects = get_data_objects(self.base_url, self.service_url, ids)
+        self.assertEqual([d.data_object_id for d in dataobjects], ids)
+        dataobject = DataObject(self.base_url,
+                                self.service_url,
+                                self.data_object_id2)
+        self.assertDictEqual(dataobjects[1].get_object(),
+                             dataobject.get_object())
+
+
+class TestAgainstFakeDSS(unittest.TestCase):
+    """Runs remote_to_bag against the lambda, served locally on top of a
+    fake DSS, see :mod:`benchmarks.fake_dss`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dss = fake_dss.shared()
+        os.environ.setdefault('DOS_METRICS', 'false')
+        from benchmarks.run import serve_lambda
+        cls.service_url = serve_lambda()
+        cls.base_url = 'ga4gh/dos/v1'
+
+    def setUp(self):
+        import app
+        from chalicelib.replicas import ReplicaTracker
+        self.catalog = fake_dss.Catalog(3, 2)
+        self.dss.catalog = self.catalog
+        self.dss.missing = {}
+        app.bundle_cache.clear()
+        app.reference_cache.clear()
+        app.replica_tracker = ReplicaTracker(app.REPLICAS)
+        self.bundles = [{'id': bundle_id}
+                        for bundle_id in self.catalog.bundle_order]
+
+    def test_get_data_objects_without_batch_endpoint(self):
+        ids = sorted(self.catalog.files)[:3]
+        not_allowed = requests.Response()
+        not_allowed.status_code = 405
+        session = requests.Session()
+        with mock.patch('remote_to_bag.get_session', return_value=session), \
+                mock.patch.object(session, 'post',
+                                  return_value=not_allowed) as post:
+            dataobjects = get_data_objects(self.base_url, self.service_url,
+                                           ids)
+            get_data_objects(self.base_url, self.service_url, ids)
+        self.assertEqual([d.data_object_id for d in dataobjects], ids)
+        self.assertEqual([d.get_object()['id'] for d in dataobjects], ids)
+        # The endpoint is only tried once per service.
+        self.assertEqual(post.call_count, 1)
+
+    def test_file_size_comes_with_the_data_object(self):
+        file_id, (_, dss_file) = sorted(self.catalog.files.items())[0]
+        dataobject = DataObject(self.base_url, self.service_url, file_id)
+        with mock.patch('remote_to_bag.get_session') as get_session:
+            self.assertEqual(dataobject.get_file_size(), str(dss_file['size']))
+        get_session.assert_not_called()
+
+    def share_files(self):
+        """Adds the first file of the first bundle to the second bundle, and
+        gives the first file of the third bundle the same sha256 as the
+        second file of the first bundle. Returns the IDs of the bundles."""
+        bundles = [self.catalog.bundles[bundle['id']]
+                   for bundle in self.bundles]
+        bundles[1]['files'].append(bundles[0]['files'][0])
+        bundles[2]['files'][0]['sha256'] = bundles[0]['files'][1]['sha256']
+        return [bundle['uuid'] for bundle in bundles]
+
+    def test_build_rfm_dedupes_overlapping_bundles(self):
+        b0, b1, b2 = self.share_files()
+        membership = {}
+        L, failures = build_rfm(self.bundles + self.bundles[:1],
+                                self.service_url, self.base_url,
+                                membership=membership)
+        self.assertEqual(failures, [])
+        # Six distinct files, one of them in two bundles
+        self.assertEqual(len(L), 6)
+        self.assertEqual(len(set(d['url'] for d in L)), 6)
+        self.assertEqual(set(membership), {b0, b1, b2})
+        self.assertEqual(len(membership[b1]), 3)
+        self.assertEqual(membership[b1][2], membership[b0][0])
+        self.assertEqual(sorted(set(f for fs in membership.values()
+                                    for f in fs)),
+                         sorted(d['filename'] for d in L))
+
+    def test_build_rfm_dedupes_sha256(self):
+        b0, _, b2 = self.share_files()
+        membership = {}
+        L, failures = build_rfm(self.bundles, self.service_url,
+                                self.base_url, dedupe_sha256=True,
+                                membership=membership)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(L), 5)
+        self.assertEqual(len(set(d['sha256'] for d in L)), 5)
+        # The duplicate points at the entry that was written.
+        self.assertEqual(membership[b2][0], membership[b0][1])
+        self.assertIn(membership[b2][0], [d['filename'] for d in L])
+
+    def test_manifest_entries_dedupe(self):
+        b0, b1, b2 = self.share_files()
+        membership = {}
+        entries = list(iter_manifest_entries(
+            self.bundles + self.bundles[:1], self.service_url,
+            self.base_url, membership=membership))
+        self.assertEqual(len(entries), 6)
+        self.assertEqual([d['filename'] for d in entries],
+                         ['dss_data_object_' + str(i) for i in range(6)])
+        self.assertEqual(membership[b1][2], membership[b0][0])
+        membership = {}
+        entries = list(iter_manifest_entries(
+            self.bundles, self.service_url, self.base_url,
+            dedupe_sha256=True, membership=membership))
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(membership[b2][0], membership[b0][1])
+
+    def test_manifest_entries_without_dedupe(self):
+        self.share_files()
+        entries = list(iter_manifest_entries(
+            self.bundles + self.bundles[:1], self.service_url,
+            self.base_url, dedupe=False))
+        self.assertEqual(len(entries), 9)
+
+    def test_make_bag_resumes_from_checkpoint(self):
+        requests_made = []
+
+        def record(r, *args, **kwargs):
+            requests_made.append(r.url)
+
+        from chalicelib.sessions import get_session
+        old_path = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        os.chdir(tmp_dir)
+        get_session().hooks['response'].append(record)
+        try:
+            with self.assertRaises(RFMBuildError):
+                make_bag(self.bundles + [{'id': 'nonexistent'}],
+                         self.service_url, self.base_url,
+                         checkpoint='checkpoint.db')
+            self.assertTrue(os.path.exists('checkpoint.db'))
+            del requests_made[:]
+            make_bag(self.bundles, self.service_url, self.base_url,
+                     checkpoint='checkpoint.db')
+            self.assertEqual(requests_made, [])
+            with open('bag_path/fetch.txt') as fp:
+                self.assertEqual(len(fp.read().splitlines()), 6)
+        finally:
+            get_session().hooks['response'].remove(record)
+            os.chdir(old_path)
+            shutil.rmtree(tmp_dir)
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    """Serves the payload of the server at every path, and the requested
+    range of it unless the server ignores ranges."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        payload = self.server.payload
+        requested = self.headers.get('Range')
+        self.server.ranges_requested.append(requested)
+        if requested and self.server.honour_ranges:
+            start = int(requested[len('bytes='):].split('-')[0])
+            body = payload[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(payload) - 1, len(payload)))
+        else:
+            body = payload
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestFetchFile(unittest.TestCase):
+    """Downloads files from a local HTTP server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PayloadHandler)
+        self.server.daemon_threads = True
+        self.server.payload = os.urandom(100000)
+        self.server.honour_ranges = True
+        self.server.ranges_requested = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/payload.bin'.format(
+            self.server.server_address[1])
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'payload.bin')
+        self.entry = {
+            'url': self.url,
+            'filename': 'payload.bin',
+            'length': len(self.server.payload),
+            'sha256': hashlib.sha256(self.server.payload).hexdigest(),
+            'sha1': hashlib.sha1(self.server.payload).hexdigest()}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def write_part(self, data):
+        with open(self.path + '.part', 'wb') as fp:
+            fp.write(data)
+
+    def assertFetched(self):
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), self.server.payload)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_fetch_file(self):
+        self.assertEqual(fetch_file(self.entry, ['gs://bucket/payload.bin',
+                                                 self.url],
+                                    self.data_dir, chunk_size=4096),
+                         self.path)
+        self.assertFetched()
+        self.assertEqual(self.server.ranges_requested, [None])
+        # A file in place is not fetched again.
+        fetch_file(self.entry, [self.url], self.data_dir)
+        self.assertEqual(len(self.server.ranges_requested), 1)
+
+    def test_partial_download_is_resumed(self):
+        self.write_part(self.server.payload[:30000])
+        fetch_file(self.entry, [self.url], self.data_dir, chunk_size=4096)
+        self.assertFetched()
+        self.assertEqual(self.server.ranges_requested, ['bytes=30000-'])
+
+    def test_download_starts_over_if_the_range_is_ignored(self):
+        self.server.honour_ranges = False
+        self.write_part(b'x' * 30000)
+        fetch_file(self.entry, [self.url], self.data_dir, chunk_size=4096)
+        self.assertFetched()
+        self.assertEqual(self.server.ranges_requested, ['bytes=30000-'])
+
+    def test_checksum_mismatch_deletes_the_partial_download(self):
+        self.entry['sha256'] = '0' * 64
+        with self.assertRaises(ChecksumMismatch):
+            fetch_file(self.entry, [self.url], self.data_dir)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_short_download_is_kept_for_resuming(self):
+        self.entry['length'] += 10
+        with self.assertRaises(IOError):
+            fetch_file(self.entry, [self.url], self.data_dir)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(os.path.getsize(self.path + '.part'),
+                         len(self.server.payload))
+
+    def test_files_without_http_url_are_skipped(self):
+        with self.assertRaises(NoHTTPURL):
+            fetch_file(self.entry, ['gs://bucket/payload.bin'], self.data_dir)
+        fileref = dict(self.entry, url='gs://bucket/fileref.bin',
+                       filename='fileref.bin')
+        failures, skipped = [], []
+        self.assertEqual(fetch_payload([self.entry, fileref], self.data_dir,
+                                       'http://127.0.0.1:1', 'ga4gh/dos/v1',
+                                       failures=failures, skipped=skipped),
+                         1)
+        self.assertFetched()
+        self.assertEqual(failures, [])
+        self.assertEqual([f.id for f in skipped], ['fileref.bin'])
+